@@ -0,0 +1,239 @@
+#
+#   Benchmarks for the SB9600 routines, run against the simulated bus so no
+#   hardware is needed. panel_single and panel_batch run the bus at real 9600
+#   baud timing, comparing front panel updates sent one SBEP entry at a time
+#   with the same updates batched into one session.
+#
+#   python bench.py                 run everything and compare to the baseline
+#   python bench.py --save          run everything and store a new baseline
+#   python bench.py parse decode    only run some benchmarks
+#
+#   Exits non-zero if anything has got slower than the baseline by more than
+#   the threshold (20% by default). Baselines are machine specific, so run
+#   with --save on your own machine first.
+#
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import sb9600
+import simbus
+import xtl5000
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def traffic():
+    """A mix of typical XTL bus traffic as (sbep, frame) pairs"""
+    f = sb9600.sb9600_frame
+    text = "HELLO"
+    return [
+        (False, f(0x05, 0x01, 0x01, 0x57)),
+        (False, f(0x05, 0x01, 0x00, 0x57)),
+        (False, f(0x05, 0x04, 0x02, 0x57)),
+        (False, f(0x00, 0x03, 0x01, 0x0a)),
+        (False, f(0x00, 0x01, 0x00, 0x0a)),
+        (False, f(0x01, 0x00, 0x01, 0x1d)),
+        (False, f(0x01, 0x00, 0x00, 0x1e)),
+        (False, f(0x01, 0x00, 0x05, 0x1f)),
+        (False, f(0x01, 0x1a, 0x00, 0x3c)),
+        (False, f(0x05, 0x02, 0x40, 0x58)),
+        (False, f(0x00, 0x12, 0x05, 0x06)),
+        (True, sb9600.sbep_frame(0x01, bytes((0x80, 5, 5, 0x01, 0)) + text.encode() + b"\x00" * 5)),
+        (False, f(0x00, 0x12, 0x05, 0x06)),
+        (True, sb9600.sbep_frame(0x21, bytes((0x01, 0x10, 0x01)))),
+        (False, f(0x09, 0x01, 0x02, 0x03)),
+    ]
+
+
+def best(fn, repeat=7):
+    """Best time of several runs of fn()"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# Each benchmark returns (value, unit, higher_is_better)
+
+def bench_crc_sb9600():
+    msgs = [bytes(random.randrange(256) for i in range(4)) for j in range(1000)]
+    crc = sb9600.sb9600_CRC
+
+    def run():
+        for m in msgs:
+            crc(m)
+    return len(msgs) / best(run), "msgs/sec", True
+
+
+def bench_crc_sbep():
+    msgs = [bytes(random.randrange(256) for i in range(67)) for j in range(1000)]
+    crc = sb9600.sbep_CRC
+
+    def run():
+        for m in msgs:
+            crc(m)
+    return len(msgs) * 67 / best(run), "bytes/sec", True
+
+
+def bench_parse():
+    frames = traffic() * 2000
+    stream = b"".join(m for s, m in frames)
+    rng = random.Random(9600)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        n = rng.randint(1, 32)
+        chunks.append(stream[pos:pos + n])
+        pos += n
+
+    def run():
+        parser = sb9600.FrameParser()
+        for c in chunks:
+            for frame in parser.feed(c):
+                pass
+    return len(frames) / best(run), "frames/sec", True
+
+
+def bench_decode():
+    frames = traffic() * 2000
+    xtl = xtl5000.XTL(None, sinks=[])
+    # The same few frames over and over would only measure cache hits
+    xtl.decodeCacheSize = 0
+
+    def run():
+        for sbep, msg in frames:
+            xtl.processMsg(msg, sbep)
+    return len(frames) / best(run), "frames/sec", True
+
+
+def bench_sb9600_send():
+    bus = simbus.Serial(realtime=False)
+    count = 200
+
+    def run():
+        for i in range(count):
+            bus.sb9600_send(0x05, 0x01, i & 1, 0x57)
+    return best(run) / count * 1e6, "us/msg", False
+
+
+def bench_sbep_send():
+    bus = simbus.Serial(realtime=False)
+    xtl = xtl5000.XTL(bus, sinks=[])
+    count = 200
+
+    def run():
+        xtl.SBEP(xtl5000.MODULE_FRONTPANEL)
+        for i in range(count):
+            bus.sbep_send(0x21, bytes((0x01, 0x10, i & 1)))
+        bus.sbep_leave()
+    return best(run) / count * 1e6, "us/msg", False
+
+
+def _panelUpdates(batched):
+    """Front panel updates per second, one display and six lamps at a time"""
+    bus = simbus.Serial()
+    xtl = xtl5000.XTL(bus, sinks=[])
+    lamps = (0x14, 0x15, 0x16, 0x17, 0x18, 0x19)
+    frames = 5
+
+    def run():
+        for i in range(frames):
+            if batched:
+                with xtl.session() as s:
+                    s.display("FRAME {}".format(i))
+                    for l in lamps:
+                        s.lamp(l, i & 1)
+            else:
+                xtl.Display("FRAME {}".format(i))
+                for l in lamps:
+                    xtl.Lamp(l, i & 1)
+    return frames * (1 + len(lamps)) / best(run, repeat=3), "updates/sec", True
+
+
+def bench_panel_single():
+    return _panelUpdates(False)
+
+
+def bench_panel_batch():
+    return _panelUpdates(True)
+
+
+def bench_eeprom():
+    size = 0x8000
+    radio = simbus.VirtualRadio(eeprom=os.urandom(size))
+    bus = simbus.Serial(radio, realtime=False)
+    xtl = xtl5000.XTL(bus, sinks=[])
+    elapsed = best(lambda: xtl.ReadEEPROM(1, 0, size), repeat=3)
+    return elapsed, "sec/32KB", False
+
+
+BENCHMARKS = {
+    "crc_sb9600": bench_crc_sb9600,
+    "crc_sbep": bench_crc_sbep,
+    "parse": bench_parse,
+    "decode": bench_decode,
+    "sb9600_send": bench_sb9600_send,
+    "sbep_send": bench_sbep_send,
+    "panel_single": bench_panel_single,
+    "panel_batch": bench_panel_batch,
+    "eeprom": bench_eeprom,
+}
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark the SB9600 routines")
+    argp.add_argument("names", nargs="*", help="benchmarks to run (default all): " + ", ".join(BENCHMARKS))
+    argp.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    argp.add_argument("--baseline", default=BASELINE, help="baseline file")
+    argp.add_argument("--threshold", type=float, default=0.2, help="allowed regression as a fraction (default 0.2)")
+    args = argp.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            argp.error("unknown benchmark {}".format(name))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = []
+    for name in names:
+        value, unit, higher = BENCHMARKS[name]()
+        results[name] = {"value": value, "unit": unit, "higher_is_better": higher}
+        line = "{: >12}: {:>14.2f} {}".format(name, value, unit)
+        base = baseline.get(name)
+        if base and not args.save:
+            # Positive change is an improvement either way round
+            change = (value - base["value"]) / base["value"]
+            if not higher:
+                change = -change
+            status = "ok"
+            if change < -args.threshold:
+                status = "REGRESSION"
+                failed.append(name)
+            line += "  ({:+.1f}% vs baseline {:.2f}) {}".format(change * 100, base["value"], status)
+        print(line)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print("Saved baseline to {}".format(args.baseline))
+    elif failed:
+        print("Regressed by more than {:.0f}%: {}".format(args.threshold * 100, ", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# Binary capture files for SB9600/SBEP bus traffic
+#
+# A capture is a stream of timestamped frames as split up by
+# sb9600.FrameParser, plus a sidecar index of record offsets so any frame can
+# be found without scanning the file. Replay memory-maps both, so millions of
+# frames can be pushed back through the decoder without reading them all in.
+#
+# Capture file (.sbc):
+#   8 byte magic b"SB96CAP1"
+#   records of: int64 timestamp (ns since epoch), uint8 flags, uint16 length,
+#               then the frame bytes. All little-endian.
+#   flags bit 0 set for SBEP messages
+#
+# Index file (.sbc.idx):
+#   8 byte magic b"SB96IDX1"
+#   uint64 offset of each record in the capture file, little-endian
+#
+
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+CAPTURE_MAGIC = b"SB96CAP1"
+INDEX_MAGIC = b"SB96IDX1"
+
+FLAG_SBEP = 0x01
+
+_record = struct.Struct("<qBH")
+
+
+def indexPath(path):
+    """Sidecar index file name for a capture file"""
+    return path + ".idx"
+
+
+class CaptureWriter:
+    """Write frames to a capture file and its index"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.index = open(indexPath(path), "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.index.write(INDEX_MAGIC)
+        self.offset = len(CAPTURE_MAGIC)
+        self.count = 0
+
+    def write(self, frame, sbep=False, timestamp=None):
+        """Append a frame
+
+        Args:
+            frame (bytes): the frame including CRC/checksum
+            sbep (bool, optional): whether it's an SBEP message
+            timestamp (int, optional): receive time in ns since epoch.
+                                       Defaults to now.
+        """
+        if timestamp is None:
+            timestamp = time.time_ns()
+        self.index.write(self.offset.to_bytes(8, "little"))
+        self.file.write(_record.pack(timestamp, FLAG_SBEP if sbep else 0, len(frame)))
+        self.file.write(frame)
+        self.offset += _record.size + len(frame)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    """Memory-mapped random access to a capture file
+
+    Frames come back as memoryviews into the mapping, so nothing is copied
+    until the caller does it. The index is rebuilt by scanning the capture if
+    it's missing or doesn't cover the whole file (e.g. after a crash).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self._indexFile = None
+        self._indexMap = None
+        if bytes(self.view[:len(CAPTURE_MAGIC)]) != CAPTURE_MAGIC:
+            self.close()
+            raise ValueError("Not an SB9600 capture file")
+        self.offsets = self._loadIndex()
+
+    def _loadIndex(self):
+        """Map the sidecar index, or scan the capture if it's no good"""
+        try:
+            self._indexFile = open(indexPath(self.path), "rb")
+            size = os.fstat(self._indexFile.fileno()).st_size
+            if size > len(INDEX_MAGIC) and sys.byteorder == "little":
+                self._indexMap = mmap.mmap(self._indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+                n = (size - len(INDEX_MAGIC)) // 8
+                view = memoryview(self._indexMap)
+                # n is 0 if we crashed before the first entry was complete
+                if n > 0 and bytes(view[:len(INDEX_MAGIC)]) == INDEX_MAGIC:
+                    offsets = view[len(INDEX_MAGIC):len(INDEX_MAGIC) + n * 8].cast("Q")
+                    # Check the last record ends at the end of the capture
+                    last = offsets[-1]
+                    length = _record.unpack_from(self.map, last)[2]
+                    if last + _record.size + length == len(self.map):
+                        view.release()
+                        return offsets
+                    offsets.release()
+                view.release()
+        except (OSError, struct.error):
+            pass
+        return self._scan()
+
+    def _scan(self):
+        offsets = array("Q")
+        pos = len(CAPTURE_MAGIC)
+        end = len(self.map)
+        while pos + _record.size <= end:
+            length = _record.unpack_from(self.map, pos)[2]
+            if pos + _record.size + length > end:
+                # Truncated last record
+                break
+            offsets.append(pos)
+            pos += _record.size + length
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        """Get a record
+
+        Returns:
+            (int, bool, memoryview): timestamp in ns, whether it's an SBEP
+                                     message, and the frame
+        """
+        pos = self.offsets[i]
+        timestamp, flags, length = _record.unpack_from(self.map, pos)
+        pos += _record.size
+        return timestamp, bool(flags & FLAG_SBEP), self.view[pos:pos + length]
+
+    def __iter__(self):
+        unpack = _record.unpack_from
+        size = _record.size
+        for pos in self.offsets:
+            timestamp, flags, length = unpack(self.map, pos)
+            pos += size
+            yield timestamp, bool(flags & FLAG_SBEP), self.view[pos:pos + length]
+
+    def close(self):
+        if isinstance(getattr(self, "offsets", None), memoryview):
+            self.offsets.release()
+        self.view.release()
+        self.map.close()
+        self.file.close()
+        if self._indexMap is not None:
+            self._indexMap.close()
+        if self._indexFile is not None:
+            self._indexFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def replay(reader, xtl, realtime=False, speed=1.0, start=0, stop=None, frameFilter=None):
+    """Feed captured frames through a decoder
+
+    Args:
+        reader (CaptureReader): capture to replay
+        xtl (xtl5000.XTL): decoder to drive
+        realtime (bool, optional): keep the original gaps between frames,
+                                   otherwise go as fast as possible
+        speed (float, optional): speed-up factor when replaying in real time
+        start (int, optional): first record to replay
+        stop (int, optional): record to stop before
+        frameFilter (framefilter.FrameFilter, optional): only decode frames
+                                                         it passes
+
+    Returns:
+        int: number of frames replayed, not counting any the filter skipped
+    """
+    if stop is None:
+        stop = len(reader)
+    process = xtl.processMsg
+    count = 0
+    first = None
+    began = time.perf_counter()
+    for i in range(start, stop):
+        timestamp, sbep, frame = reader[i]
+        if frameFilter is not None and not frameFilter(frame, sbep):
+            continue
+        if realtime:
+            if first is None:
+                first = timestamp
+            due = began + (timestamp - first) / 1e9 / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        process(frame, sbep, timestamp / 1e9)
+        count += 1
+    return count
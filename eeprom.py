@@ -0,0 +1,372 @@
+# EEPROM reading over SBEP
+#
+# Reads go into a preallocated buffer, or a memory-mapped file, a chunk at a
+# time. A sidecar checkpoint records which chunks have been read, so a dump
+# that fails part way through (or gets interrupted) picks up where it left
+# off rather than starting again from scratch.
+#
+# Checkpoint file (<out>.chunks):
+#   4 byte magic b"SBEE", uint32 start address, uint32 size, uint16 chunk
+#   size (little-endian), then one byte per chunk, non-zero once it's read
+#
+
+import mmap
+import os
+import struct
+import time
+from collections import deque
+from time import sleep
+
+import sb9600
+
+MODULE_BCAST = 0
+MODULE_RADIO = 1
+
+_header = struct.Struct("<4sIIH")
+_MAGIC = b"SBEE"
+
+
+def _mapFile(path, size):
+    """Open a file, make it size bytes long and memory-map it"""
+    f = open(path, "r+b" if os.path.exists(path) else "w+b")
+    if os.fstat(f.fileno()).st_size != size:
+        f.truncate(size)
+    return f, mmap.mmap(f.fileno(), size)
+
+
+class ChunkStore:
+    """EEPROM contents being filled in a chunk at a time
+
+    Without a path everything is kept in memory. With one, the data is a
+    memory-mapped file and which chunks are filled in is recorded in a
+    checkpoint file next to it, so it survives between runs.
+    """
+
+    def __init__(self, start, size, chunk, path=None):
+        """
+        Args:
+            start (int): EEPROM address of the first byte
+            size (int): number of bytes. The last chunk is short if it isn't
+                        a whole number of chunks.
+            chunk (int): chunk size
+            path (str, optional): file to keep the data in
+        """
+        self.start = start
+        self.chunk = chunk
+        self.count = -(-size // chunk)
+        self.size = size
+        self.path = path
+        self._files = []
+
+        if path is None:
+            self.data = bytearray(self.size)
+            self.done = bytearray(self.count)
+            return
+
+        header = _header.pack(_MAGIC, start, self.size, chunk)
+        f, self._doneMap = _mapFile(path + ".chunks", _header.size + self.count)
+        self._files.append(f)
+        if self._doneMap[:_header.size] != header:
+            # New dump, or a checkpoint for a different one
+            self._doneMap[:] = header + bytes(self.count)
+        self.done = memoryview(self._doneMap)[_header.size:]
+
+        f, self._dataMap = _mapFile(path, self.size)
+        self._files.append(f)
+        self.data = self._dataMap
+
+    def missing(self):
+        """Addresses of the chunks still to be read"""
+        return [self.start + i * self.chunk for i in range(self.count) if not self.done[i]]
+
+    def complete(self):
+        return all(self.done)
+
+    def chunkLength(self, addr):
+        """Bytes in the chunk at address addr, the last one may be short"""
+        return min(self.chunk, self.start + self.size - addr)
+
+    def put(self, addr, data):
+        """Store a chunk read from address addr"""
+        pos = addr - self.start
+        self.data[pos:pos + len(data)] = data
+        # Only mark it read once the data's in place
+        self.done[pos // self.chunk] = 1
+
+    def has(self, addr):
+        return bool(self.done[(addr - self.start) // self.chunk])
+
+    def flush(self):
+        if self.path is not None:
+            self._dataMap.flush()
+            self._doneMap.flush()
+
+    def close(self):
+        if self.path is not None:
+            self.flush()
+            self.done.release()
+            self._dataMap.close()
+            self._doneMap.close()
+            for f in self._files:
+                f.close()
+
+
+class EEPROMReader:
+    """Read a range of EEPROM over SBEP
+
+    Usage:
+        reader = EEPROMReader(xtl, 1, 0, 0x8000, out="EEDUMP.bin")
+        reader.read()
+        print("{:.0f} bytes/sec".format(reader.rate))
+
+    If 'out' already has a checkpoint for the same range, only the chunks it
+    hasn't got yet are read.
+    """
+
+    def __init__(self, ctrl, module, startaddr, endaddr, chunk=0x40, out=None,
+                 retries=3, callback=None, speed=9600):
+        """
+        Args:
+            ctrl: controller (xtl5000.XTL, gm1200.GM1200) for the radio
+            module (int): EEPROM device to select
+            startaddr (int): first address to read
+            endaddr (int): address to stop before
+            chunk (int, optional): bytes per read request, up to 0xFF
+            out (str, optional): file to write to, with a checkpoint beside it
+            retries (int, optional): times to re-enter SBEP mode and carry on
+                                     after a failed read
+            callback (callable, optional): called with each address read
+            speed (int, optional): SBEP baud rate to read at, see
+                                   sb9600.SBEP_SPEEDS
+        """
+        if not 0 < chunk <= 0xFF:
+            raise ValueError("Chunk size must be 1 to 255 bytes")
+        self.ctrl = ctrl
+        self.bus = ctrl.bus
+        self.module = module
+        self.chunk = chunk
+        self.retries = retries
+        self.callback = callback
+        self.speed = speed
+        self.store = ChunkStore(startaddr, endaddr - startaddr, chunk, out)
+
+        self.bytesRead = 0
+        self.chunksRead = 0
+        self.elapsed = 0.0
+        self.attempts = 0
+        self.preemptions = 0
+
+    @property
+    def rate(self):
+        """Bytes per second read over the bus"""
+        return self.bytesRead / self.elapsed if self.elapsed else 0.0
+
+    def _begin(self):
+        """Put the radio into EEPROM read mode. It'll need a reset afterwards!"""
+        self.ctrl.CSQ()
+        self.bus.wait_for_quiet()
+
+        # Select device? (TODO: What is this?)
+        # You'll need to reset the radio after this command
+        self.bus.sb9600_send(MODULE_BCAST, self.module, 0x01, 0x08)
+
+        # Must wait some time before entering SBEP mode
+        sleep(0.5)
+        self.ctrl.SBEP(MODULE_RADIO, self.speed)
+
+    def _request(self, addr):
+        return bytes((self.store.chunkLength(addr), (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF))
+
+    def _preempted(self):
+        """True if a command gateway has urgent commands to let through"""
+        gateway = self.bus.gateway
+        return gateway is not None and gateway.wantsBus()
+
+    def _stepAside(self):
+        """Let urgent commands through, with SBEP mode already left"""
+        self.preemptions += 1
+        self.bus.gateway.runUrgent()
+
+    def _readChunks(self, pending):
+        """Read chunks until pending is empty, within one SBEP session
+
+        Stops early, between chunks, if a command gateway has urgent commands
+        waiting.
+        """
+        while pending:
+            if self._preempted():
+                return
+            addr = pending.popleft()
+            self.bus.sbep_send(0x11, self._request(addr))
+
+            op, data = self.bus.sbep_recv()
+            if op != 0x80:  # Reply is EEPROM data
+                raise RuntimeError("Unexpected reply op=%d" % op)
+            addr_rx = data[0] << 16 | data[1] << 8 | data[2]
+            if addr_rx != addr:
+                raise RuntimeError("Unexpected address in reply addr=0x%x" % addr_rx)
+            if len(data) - 3 != self.store.chunkLength(addr):
+                raise RuntimeError("Unexpected data length!")
+            self.store.put(addr, data[3:])
+            self.bytesRead += len(data) - 3
+            self.chunksRead += 1
+
+            # Notify of progress
+            if self.callback:
+                self.callback(addr)
+
+    def read(self):
+        """Read everything that hasn't been read yet
+
+        Raises:
+            RuntimeError: if reads still fail after all the retries
+
+        Returns:
+            bytes-like: the EEPROM data, from a memory-mapped file if 'out'
+                        was given
+        """
+        start = time.perf_counter()
+        try:
+            failures = 0
+            while not self.store.complete():
+                pending = deque(self.store.missing())
+                self.attempts += 1
+                self._begin()
+                try:
+                    self._readChunks(pending)
+                except RuntimeError:
+                    failures += 1
+                    if failures > self.retries:
+                        raise
+                finally:
+                    # Done with SBEP mode
+                    self.bus.sbep_leave()
+                    self.store.flush()
+                if self._preempted():
+                    self._stepAside()
+        finally:
+            self.elapsed += time.perf_counter() - start
+        return self.store.data
+
+    def close(self):
+        self.store.close()
+
+
+class EEPROMView(EEPROMReader):
+    """EEPROM that's read a page at a time as it's looked at
+
+    Indexing and slicing work like bytes, with index 0 at startaddr. The first
+    time a page is touched the radio is put into EEPROM read mode and the page
+    fetched; the SBEP session then stays open for later pages until close().
+    With 'out' given, fetched pages are kept in a file between runs, so pages
+    read before never go over the bus again.
+
+    Usage:
+        with EEPROMView(xtl, 1, out="EEPAGES.bin") as ee:
+            serial = ee[0x100:0x110]
+
+    Remember the radio needs a reset once you're done.
+    """
+
+    def __init__(self, ctrl, module, startaddr=0, endaddr=0x8000, page=0x40, out=None,
+                 retries=3, callback=None, speed=9600):
+        """
+        Args:
+            ctrl: controller (xtl5000.XTL, gm1200.GM1200) for the radio
+            module (int): EEPROM device to select
+            startaddr (int, optional): address of index 0
+            endaddr (int, optional): address to stop before
+            page (int, optional): bytes fetched at a time, up to 0xFF
+            out (str, optional): file to cache pages in, with a checkpoint
+                                 beside it
+            retries (int, optional): times to re-enter SBEP mode after a
+                                     failed fetch
+            callback (callable, optional): called with each address fetched
+            speed (int, optional): SBEP baud rate to read at
+        """
+        super().__init__(ctrl, module, startaddr, endaddr, chunk=page, out=out,
+                         retries=retries, callback=callback, speed=speed)
+        self.length = endaddr - startaddr
+        self.pagesFetched = 0
+        self._inSession = False
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            wanted = range(*index.indices(self.length))
+            if not wanted:
+                return b""
+            self.fetch(min(wanted[0], wanted[-1]), max(wanted[0], wanted[-1]) + 1)
+            # A negative step can stop at -1, meaning before index 0 rather
+            # than the last byte
+            stop = None if wanted.stop < 0 else wanted.stop
+            return bytes(self.store.data[wanted.start:stop:wanted.step])
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("EEPROM address out of range")
+        self.fetch(index, index + 1)
+        return self.store.data[index]
+
+    def fetch(self, start, stop):
+        """Make sure the pages covering [start, stop) have been read
+
+        Args:
+            start (int): first index needed
+            stop (int): index to stop before
+
+        Raises:
+            RuntimeError: if the pages still can't be read after all the
+                          retries
+        """
+        store = self.store
+        first = start - start % self.chunk
+        missing = [store.start + i for i in range(first, stop, self.chunk)
+                   if not store.done[i // self.chunk]]
+        if not missing:
+            return
+
+        began = time.perf_counter()
+        failures = 0
+        try:
+            while missing:
+                if not self._inSession:
+                    self.attempts += 1
+                    self._begin()
+                    self._inSession = True
+                try:
+                    self._readChunks(deque(missing))
+                except RuntimeError:
+                    # Start over with a fresh session for whatever's left
+                    self._leave()
+                    failures += 1
+                    if failures > self.retries:
+                        raise
+                if self._preempted():
+                    self._leave()
+                    self._stepAside()
+                missing = [addr for addr in missing if not store.has(addr)]
+        finally:
+            self.elapsed += time.perf_counter() - began
+            store.flush()
+            self.pagesFetched = self.chunksRead
+
+    def _leave(self):
+        if self._inSession:
+            self._inSession = False
+            self.bus.sbep_leave()
+
+    def close(self):
+        """Leave SBEP mode and close the page cache"""
+        try:
+            self._leave()
+        finally:
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,174 @@
+# Decoded SB9600/SBEP events and the sinks they get delivered to
+#
+# The decoder produces small Event records rather than printing text. Text is
+# only built when a sink asks for it, so nothing is formatted unless
+# something is actually going to display or store it.
+#
+
+import time
+from binascii import hexlify
+from queue import Full
+from typing import NamedTuple
+
+
+class Event(NamedTuple):
+    """A decoded SB9600/SBEP message
+
+    Attributes:
+        timestamp (float): when the message was received, seconds since epoch
+        source (str): module the message was addressed to (BCAST, RADIO,
+                      PANEL, ...)
+        kind (str): what sort of message it is, see FORMATS
+        fields (dict): decoded values. Shared between events for the same
+                       message, so treat it as read-only.
+        raw (bytes): the message as received, including CRC/checksum
+    """
+    timestamp: float
+    source: str
+    kind: str
+    fields: dict
+    raw: bytes
+
+    def label(self):
+        """Short description of the kind of message"""
+        return FORMATS[self.kind][0]
+
+    def message(self):
+        """Human-readable decoded message"""
+        return FORMATS[self.kind][1](self)
+
+    def text(self):
+        """The decoded message as printed by the listener"""
+        label, fmt = FORMATS[self.kind]
+        if label is None:
+            return fmt(self)
+        return "{: >10} >>: {}".format(label, fmt(self))
+
+
+def _onOff(on, upper=True):
+    if upper:
+        return "ON" if on else "OFF"
+    return "on" if on else "off"
+
+
+def _knob(e):
+    return "{} clicks: {}".format(e.fields['name'], e.fields['value'])
+
+
+def _button(e):
+    return "{} {}".format(e.fields['name'], "pressed" if e.fields['value'] == 0x01 else "released")
+
+
+def _channel(e):
+    f = e.fields
+    if f['state'] == 'idle':
+        return "Idle state"
+    elif f['state'] == 'rx':
+        return "RX state"
+    return "Unknown state: {} {}".format(hex(f['param1']), hex(f['param2']))
+
+
+def _hexOrNone(value):
+    return None if value is None else hex(value)
+
+
+def _sbepRaw(e):
+    f = e.fields
+    return ("RECVD<: SBEP decoded\n"
+            "        Raw Msg: {}\n"
+            "        Address: {}, Subaddr: {}, Length: {}, Opcode: {}").format(
+        hexlify(e.raw, ' '), _hexOrNone(f.get('address')), _hexOrNone(f.get('subaddr')),
+        f.get('length'), _hexOrNone(f.get('opcode')))
+
+
+# Event kind -> (label, formatter). A label of None means the formatter
+# produces the whole text itself.
+FORMATS = {
+    'sbep_enter': ("SBEP", lambda e: "Entering SBEP mode to {} at {} baud".format(e.fields['module'], e.fields['speed'])),
+    'chan_state': ("Chan State", lambda e: "{} {}".format(e.fields['mode'], _onOff(e.fields['on']))),
+    'button': ("Btn/Knob", _button),
+    'knob': ("Btn/Knob", _knob),
+    'lighting': ("Lighting", lambda e: "{} BL set to {}".format(e.fields['target'], e.fields['level'])),
+    'audio': ("Audio", lambda e: "Muted" if e.fields['muted'] else "Unmuted"),
+    'channel': ("Channel", _channel),
+    'chan_change': ("Chan Change", lambda e: "Goto CH {}{}".format(e.fields['channel'], " OK" if e.fields['ack'] else "")),
+    'unknown_bcast': ("Unknown", lambda e: "Unknown broadcast message function {}: params {}, {}".format(hex(e.fields['function']), hex(e.fields['param1']), hex(e.fields['param2']))),
+    'unknown_radio': ("Unknown", lambda e: "Unknown message for radio module (0x01): func {}, params {} {}".format(hex(e.fields['function']), hex(e.fields['param1']), hex(e.fields['param2']))),
+    'raw': ("Unknown", lambda e: "Raw SB9600: {}".format(hexlify(e.raw, ' '))),
+    'display': ("SBEP Disp", lambda e: "Set {} to '{}'".format(e.fields['subdev'], e.fields['text'])),
+    'icon': ("SBEP Icon", lambda e: "{} ({}) icon {}".format(e.fields['icon'], hex(e.fields['code']), _onOff(e.fields['on'], False))),
+    'sbep_raw': (None, _sbepRaw),
+}
+
+
+class ConsoleSink:
+    """Print events to the console the way the listener always has"""
+
+    def __init__(self, quiet=('sbep_enter',)):
+        """
+        Args:
+            quiet (tuple, optional): event kinds not to print
+        """
+        self.quiet = frozenset(quiet)
+
+    def __call__(self, event):
+        if event.kind not in self.quiet:
+            print(event.text())
+
+
+class FileSink:
+    """Write timestamped event text to a file"""
+
+    def __init__(self, file, quiet=()):
+        """
+        Args:
+            file (str or file): path to append to, or an open text file
+            quiet (tuple, optional): event kinds not to write
+        """
+        if isinstance(file, str):
+            file = open(file, "a")
+        self.file = file
+        self.quiet = frozenset(quiet)
+
+    def __call__(self, event):
+        if event.kind not in self.quiet:
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event.timestamp))
+            self.file.write("{}.{:03d} {}\n".format(stamp, int(event.timestamp * 1000) % 1000, event.text()))
+
+    def close(self):
+        self.file.close()
+
+
+class QueueSink:
+    """Put events on a queue for another thread to deal with
+
+    The put never blocks. If the queue is full the event is dropped and
+    counted in dropped.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.dropped = 0
+
+    def __call__(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+
+class CallbackSink:
+    """Call a function for each event, optionally only for some kinds"""
+
+    def __init__(self, callback, kinds=None):
+        """
+        Args:
+            callback (callable): called with each Event
+            kinds (tuple, optional): only pass on these event kinds
+        """
+        self.callback = callback
+        self.kinds = None if kinds is None else frozenset(kinds)
+
+    def __call__(self, event):
+        if self.kinds is None or event.kind in self.kinds:
+            self.callback(event)
@@ -0,0 +1,310 @@
+#
+#   Share one radio's decoded traffic with several local programs
+#
+#   Only one process can have the serial port open. This one owns it,
+#   decodes everything once and streams the events to any number of clients
+#   over a Unix socket or a localhost TCP port, one JSON object per line.
+#
+#   python fanout.py [port] --listen /tmp/sb9600.sock     serve on a Unix socket
+#   python fanout.py [port] --listen 9601                 serve on localhost:9601
+#   python fanout.py --connect /tmp/sb9600.sock           print events from a server
+#
+#   Every client has its own bounded queue. A client that doesn't keep up
+#   loses its oldest events rather than holding up the serial port, and is
+#   sent a {"kind": "dropped", "count": N} line saying how many it missed.
+#
+
+import argparse
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+from binascii import hexlify
+from collections import deque
+
+
+def _listenSocket(address):
+    """Make a listening socket for a Unix socket path, or a localhost port"""
+    if isinstance(address, int) or (isinstance(address, str) and address.isdigit()):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", int(address)))
+    elif isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+    sock.listen(16)
+    sock.setblocking(False)
+    return sock
+
+
+def _connectSocket(address):
+    if isinstance(address, int) or (isinstance(address, str) and address.isdigit()):
+        return socket.create_connection(("127.0.0.1", int(address)))
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def encodeEvent(event):
+    """An events.Event as a line of JSON"""
+    return (json.dumps({
+        'timestamp': event.timestamp,
+        'source': event.source,
+        'kind': event.kind,
+        'fields': event.fields,
+        'raw': hexlify(event.raw).decode(),
+        'text': event.text(),
+    }) + "\n").encode()
+
+
+class _Client:
+    def __init__(self, sock, maxQueue):
+        self.sock = sock
+        self.queue = deque(maxlen=maxQueue)
+        self.out = b""
+        self.sent = 0
+        self.dropped = 0
+        self.unreported = 0
+
+
+class EventServer:
+    """Event sink that streams events to socket clients
+
+    Events are encoded once and queued for every client. The sink never
+    blocks: when a client's queue is full its oldest event is dropped and
+    counted. A background thread does all the socket writing.
+
+    Usage:
+        server = EventServer("/tmp/sb9600.sock")
+        xtl = xtl5000.XTL(bus, sinks=[server])
+        ...
+        server.close()
+    """
+
+    def __init__(self, address, maxQueue=1024, state=None):
+        """
+        Args:
+            address (str, int or tuple): Unix socket path, localhost port, or
+                                         (host, port)
+            maxQueue (int, optional): events to hold per client
+            state (state.RadioState, optional): if given, each new client is
+                                                sent a snapshot of it first
+        """
+        self.address = address
+        self.maxQueue = maxQueue
+        self.state = state
+        self.clients = {}
+        self.events = 0
+
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._listen = _listenSocket(address)
+        self._selector.register(self._listen, selectors.EVENT_READ, "listen")
+        self._wakeRecv, self._wakeSend = socket.socketpair()
+        self._wakeRecv.setblocking(False)
+        self._wakeSend.setblocking(False)
+        self._selector.register(self._wakeRecv, selectors.EVENT_READ, "wake")
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="EventServer", daemon=True)
+        self._thread.start()
+
+    def __call__(self, event):
+        self.events += 1
+        if not self.clients:
+            # Nobody to send it to, don't pay for formatting it
+            return
+        line = encodeEvent(event)
+        wake = False
+        with self._lock:
+            for client in self.clients.values():
+                if len(client.queue) == self.maxQueue:
+                    client.dropped += 1
+                    client.unreported += 1
+                elif not client.queue and not client.out:
+                    wake = True
+                client.queue.append(line)
+        if wake:
+            self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeSend.send(b"\0")
+        except BlockingIOError:
+            # Already plenty of wake-ups pending
+            pass
+
+    def stats(self):
+        """Per-client counts
+
+        Returns:
+            list: dicts of sent, dropped and queued events for each client
+        """
+        with self._lock:
+            return [{'sent': c.sent, 'dropped': c.dropped, 'queued': len(c.queue)}
+                    for c in self.clients.values()]
+
+    # Server thread
+
+    def _run(self):
+        while self._running:
+            for key, mask in self._selector.select():
+                if key.data == "listen":
+                    self._accept()
+                elif key.data == "wake":
+                    try:
+                        while self._wakeRecv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self._write(key.data)
+            # Start watching for writability on clients with data waiting
+            with self._lock:
+                waiting = [c for c in self.clients.values() if c.queue or c.out]
+            for client in waiting:
+                self._watch(client, selectors.EVENT_WRITE)
+
+    def _accept(self):
+        try:
+            sock, addr = self._listen.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = _Client(sock, self.maxQueue)
+        if self.state is not None:
+            client.out = (json.dumps({'kind': 'snapshot', 'state': self.state.snapshot()}) + "\n").encode()
+        with self._lock:
+            self.clients[sock.fileno()] = client
+        # Watch for reads too, so we notice when the client goes away
+        self._selector.register(sock, selectors.EVENT_READ, client)
+
+    def _watch(self, client, events):
+        try:
+            key = self._selector.get_key(client.sock)
+        except (KeyError, ValueError):
+            return
+        if key.events != events | selectors.EVENT_READ:
+            self._selector.modify(client.sock, events | selectors.EVENT_READ, client)
+
+    def _drop(self, client):
+        with self._lock:
+            self.clients.pop(client.sock.fileno(), None)
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+
+    def _write(self, client):
+        try:
+            # Clients aren't expected to say anything, empty read means gone
+            try:
+                if client.sock.recv(4096) == b"":
+                    self._drop(client)
+                    return
+            except BlockingIOError:
+                pass
+
+            while True:
+                if not client.out:
+                    with self._lock:
+                        if client.unreported:
+                            client.out = (json.dumps({'kind': 'dropped', 'count': client.unreported}) + "\n").encode()
+                            client.unreported = 0
+                        lines = list(client.queue)
+                        client.queue.clear()
+                    client.out += b"".join(lines)
+                    client.sent += len(lines)
+                    if not client.out:
+                        self._watch(client, 0)
+                        return
+                n = client.sock.send(client.out)
+                client.out = client.out[n:]
+        except BlockingIOError:
+            self._watch(client, selectors.EVENT_WRITE)
+        except OSError:
+            self._drop(client)
+
+    def close(self):
+        """Stop serving and disconnect everyone"""
+        self._running = False
+        self._wake()
+        self._thread.join()
+        for client in list(self.clients.values()):
+            self._drop(client)
+        self._selector.close()
+        self._listen.close()
+        self._wakeRecv.close()
+        self._wakeSend.close()
+        if isinstance(self.address, str) and not self.address.isdigit() and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def follow(address):
+    """Connect to an EventServer and yield each event as a dict"""
+    with _connectSocket(address) as sock:
+        with sock.makefile("r") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Share decoded SB9600/SBEP traffic with local clients")
+    argp.add_argument("port", nargs="?", default="COM2", help="serial port the RIB is on")
+    argp.add_argument("--listen", metavar="ADDR", default="9601",
+                      help="Unix socket path or localhost port to serve on (default 9601)")
+    argp.add_argument("--connect", metavar="ADDR", help="print events from a running server instead")
+    argp.add_argument("--queue", type=int, default=1024, help="events to hold for each client")
+    argp.add_argument("--filter", metavar="TERMS", action="append",
+                      help="only decode and share frames matching these terms, see framefilter.py")
+    args = argp.parse_args()
+
+    if args.connect:
+        try:
+            for event in follow(args.connect):
+                if event['kind'] == 'dropped':
+                    print("*** missed {} events".format(event['count']))
+                elif event['kind'] == 'snapshot':
+                    print("State: {}".format(event['state']))
+                else:
+                    print(event['text'])
+        except KeyboardInterrupt:
+            pass
+        return
+
+    import framefilter
+    import sb9600
+    import state
+    import xtl5000
+
+    bus = sb9600.Serial(args.port)
+    radio = state.RadioState()
+    server = EventServer(args.listen, args.queue, radio)
+    xtl = xtl5000.XTL(bus, sinks=[radio, server])
+    parser = sb9600.FrameParser()
+    keep = framefilter.FrameFilter(*args.filter) if args.filter else None
+    try:
+        while True:
+            chunk = bus.recv(timeout=0.5)
+            if not chunk:
+                continue
+            now = time.time_ns()
+            for sbep, msg in parser.feed(chunk):
+                if keep is None or keep(msg, sbep):
+                    xtl.processMsg(msg, sbep, now / 1e9)
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
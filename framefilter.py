@@ -0,0 +1,160 @@
+# Pre-decode frame filtering
+#
+# A FrameFilter decides from the raw bytes whether a frame is worth decoding
+# at all, so monitors that only care about a few messages don't pay for
+# decoding and printing everything else.
+#
+# Filters are written as terms, any of which may match:
+#
+#   00:0a                   address 0x00, function 0x0A (TX/monitor state)
+#   PANEL:57                module names from protocol.MODULES work too
+#   05:*                    anything to or from the front panel
+#   addr=05 func=57 p1=01   field by field: addr, p1, p2 and func
+#   func=40/f0              value/mask, here functions 0x40 to 0x4F
+#   sbep                    every SBEP message
+#   sbep=01                 SBEP messages by opcode (01 display, 21 lamps and
+#                           icons), with an optional mask
+#
+# Numbers are hex, with or without 0x. Terms can be given separately or
+# comma separated in one string. A filter with any sbep term also lets the
+# SBEP entry broadcast (00:06) through, since that's where the decoder finds
+# out which module later SBEP messages belong to.
+#
+# Each field is compiled to a 256 entry table of bitmaps, bit n being set for
+# byte values term n accepts. A frame matches if ANDing its fields' bitmaps
+# leaves any bit set, which is four lookups however many terms there are.
+#
+
+import protocol
+
+_FIELDS = ('addr', 'p1', 'p2', 'func')
+
+
+def _number(text, field):
+    if field == 'addr' and text.upper() in protocol.MODULES:
+        return protocol.MODULES[text.upper()]
+    value = int(text, 16)
+    if not 0 <= value <= 0xFF:
+        raise ValueError("{} out of range".format(text))
+    return value
+
+
+def _match(text, field):
+    """(value, mask) for a field's match text: value, value/mask or *"""
+    if text == '*':
+        return 0, 0
+    if '/' in text:
+        value, mask = text.split('/', 1)
+        mask = _number(mask, None)
+        return _number(value, field) & mask, mask
+    return _number(text, field), 0xFF
+
+
+def parseTerm(text):
+    """Parse one filter term
+
+    Returns:
+        dict: field ('addr', 'p1', 'p2', 'func' or 'sbep') -> (value, mask).
+              Fields not given match anything.
+
+    Raises:
+        ValueError: if the term can't be understood
+    """
+    text = text.strip()
+    try:
+        if text.lower() == 'sbep':
+            return {'sbep': (0, 0)}
+        if ':' in text and '=' not in text:
+            addr, func = text.split(':', 1)
+            return {'addr': _match(addr, 'addr'), 'func': _match(func, 'func')}
+        fields = {}
+        for part in text.split():
+            field, match = part.split('=', 1)
+            field = field.lower()
+            if field not in _FIELDS + ('sbep',):
+                raise ValueError("unknown field {}".format(field))
+            fields[field] = _match(match, field)
+        if not fields or ('sbep' in fields and len(fields) > 1):
+            raise ValueError("sbep can't be combined with other fields")
+        return fields
+    except ValueError as e:
+        raise ValueError("Invalid filter term '{}': {}".format(text, e))
+
+
+class FrameFilter:
+    """Compiled filter for raw frames
+
+    Usage:
+        keep = FrameFilter("00:0a", "PANEL:57")
+        for sbep, msg in parser.feed(chunk):
+            if keep(msg, sbep):
+                xtl.processMsg(msg, sbep)
+    """
+
+    def __init__(self, *terms):
+        """
+        Args:
+            *terms (str): filter terms, see the top of this file. Each may
+                          hold several, comma separated.
+
+        Raises:
+            ValueError: if a term can't be understood, or there are none
+        """
+        self.terms = [parseTerm(t) for text in terms for t in text.split(',') if t.strip()]
+        if not self.terms:
+            raise ValueError("Filter has no terms")
+        if any('sbep' in t for t in self.terms):
+            self.terms.append({'addr': (0x00, 0xFF), 'func': (0x06, 0xFF)})
+
+        # Bitmaps for each field by byte value. SB9600 terms have an SB9600
+        # bit, and SBEP terms an SBEP one.
+        self._tables = {field: [0] * 256 for field in _FIELDS + ('sbep',)}
+        for n, term in enumerate(self.terms):
+            bit = 1 << n
+            fields = ('sbep',) if 'sbep' in term else _FIELDS
+            for field in fields:
+                value, mask = term.get(field, (0, 0))
+                table = self._tables[field]
+                for b in range(256):
+                    if b & mask == value:
+                        table[b] |= bit
+        self._addr = self._tables['addr']
+        self._p1 = self._tables['p1']
+        self._p2 = self._tables['p2']
+        self._func = self._tables['func']
+        self._sbep = self._tables['sbep']
+
+        self.passed = 0
+        self.skipped = 0
+
+    def __call__(self, msg, sbep=False):
+        """Check a frame
+
+        Args:
+            msg (bytes): frame as given by sb9600.FrameParser
+            sbep (bool, optional): whether it's an SBEP message
+
+        Returns:
+            bool: True if it should be decoded
+        """
+        if sbep:
+            # Opcode from the header, or the byte after it if it's extended
+            opcode = msg[0] >> 4
+            if opcode == 0xF and len(msg) > 1:
+                opcode = msg[1]
+            keep = self._sbep[opcode]
+        else:
+            keep = self._addr[msg[0]] & self._p1[msg[1]] & self._p2[msg[2]] & self._func[msg[3]]
+        if keep:
+            self.passed += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def collect(self):
+        """Metric families for metrics.Metrics"""
+        return [
+            ("filter_passed_total", "counter", "Frames the filter passed on for decoding", [({}, self.passed)]),
+            ("filter_skipped_total", "counter", "Frames the filter skipped without decoding",
+             [({}, self.skipped)]),
+        ]
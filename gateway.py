@@ -0,0 +1,257 @@
+# Prioritised command gateway
+#
+# Everything that talks to the radio goes through one worker thread, taking
+# commands from a priority queue. Urgent commands (PTT, emergency) go to the
+# front of it, and long-running SBEP work (display/lamp sessions, EEPROM
+# reads) checks for them between frames: if one is waiting, it steps out of
+# SBEP mode, lets the urgent commands go, then re-enters and carries on. So
+# a key-up waits for at most one SBEP frame plus leaving SBEP mode, rather
+# than for a whole EEPROM dump.
+#
+
+import heapq
+import itertools
+import threading
+import time
+
+import metrics
+
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+_PRIORITY_NAMES = {PRIORITY_URGENT: "urgent", PRIORITY_NORMAL: "normal", PRIORITY_BULK: "bulk"}
+
+
+class CommandExpired(RuntimeError):
+    """A command's deadline passed before it could be sent"""
+
+
+class Command:
+    """A queued command, and what became of it
+
+    Attributes:
+        name (str): description of the command
+        priority (int): PRIORITY_*
+        submitted (float): perf_counter() time it was queued
+        started (float): time it started being sent, None until then
+        finished (float): time it was done with, None until then
+        result: what the command returned
+        error (Exception): what it raised, or CommandExpired
+    """
+
+    def __init__(self, fn, args, kwargs, priority, deadline, name):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.name = name or getattr(fn, "__name__", "command")
+        self.submitted = time.perf_counter()
+        self.deadline = None if deadline is None else self.submitted + deadline
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def queueLatency(self):
+        """Seconds spent waiting in the queue, None if it hasn't started"""
+        if self.started is None:
+            return None
+        return self.started - self.submitted
+
+    @property
+    def airLatency(self):
+        """Seconds from starting to send to finishing, None if not done"""
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the command to be sent
+
+        Returns:
+            whatever the command returned
+
+        Raises:
+            TimeoutError: if it isn't done within the timeout
+            Exception: whatever the command raised, or CommandExpired
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Command {} not sent yet".format(self.name))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CommandGateway:
+    """Send commands to a radio in priority order from one worker thread
+
+    The gateway's thread must be the only thing using the bus while it's
+    running. Bulk SBEP work run through it (sessions, EEPROMReader) gives way
+    to urgent commands between frames.
+
+    Usage:
+        gw = CommandGateway(xtl)
+        gw.submit(xtl.ReadEEPROM, 1, 0, 0x8000, priority=gateway.PRIORITY_BULK)
+        cmd = gw.ptt(True)
+        cmd.wait()
+        print(cmd.queueLatency, cmd.airLatency)
+        gw.close()
+    """
+
+    def __init__(self, ctrl):
+        """
+        Args:
+            ctrl: controller (xtl5000.XTL) to send through
+        """
+        self.ctrl = ctrl
+        self.bus = ctrl.bus
+        self.preemptions = 0
+        self.expired = 0
+        self.queueLatency = {p: metrics.Histogram() for p in _PRIORITY_NAMES}
+        self.airLatency = {p: metrics.Histogram() for p in _PRIORITY_NAMES}
+
+        self._queue = []
+        self._seq = itertools.count()
+        self._urgent = 0
+        self._runningUrgent = False
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="CommandGateway", daemon=True)
+        self._thread.start()
+        self.bus.gateway = self
+
+    # Queueing commands
+
+    def submit(self, fn, *args, priority=PRIORITY_NORMAL, deadline=None, name=None, **kwargs):
+        """Queue a command
+
+        Args:
+            fn (callable): called with args and kwargs on the gateway thread
+            priority (int, optional): PRIORITY_URGENT, PRIORITY_NORMAL or
+                                      PRIORITY_BULK
+            deadline (float, optional): seconds it may wait in the queue
+                                        before being given up on
+            name (str, optional): description for reporting
+
+        Returns:
+            Command: to wait on and get latencies from
+        """
+        cmd = Command(fn, args, kwargs, priority, deadline, name)
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("Gateway has been closed")
+            heapq.heappush(self._queue, (priority, next(self._seq), cmd))
+            if priority == PRIORITY_URGENT:
+                self._urgent += 1
+            self._cond.notify()
+        return cmd
+
+    def call(self, method, *args, priority=PRIORITY_NORMAL, deadline=None, **kwargs):
+        """Queue a controller method by name, e.g. call("Display", "HELLO")"""
+        return self.submit(getattr(self.ctrl, method), *args, priority=priority, deadline=deadline,
+                           name=method, **kwargs)
+
+    def ptt(self, keyed, deadline=None):
+        """Key up or unkey, ahead of everything else"""
+        return self.submit(self.ctrl.sendButton, self.ctrl.buttonCode('ptt'), 1 if keyed else 0,
+                           priority=PRIORITY_URGENT, deadline=deadline, name="ptt")
+
+    def emergency(self, pressed=True, deadline=None):
+        """Press or release the emergency button, ahead of everything else"""
+        return self.submit(self.ctrl.sendButton, self.ctrl.buttonCode('btn_emgcy'), 1 if pressed else 0,
+                           priority=PRIORITY_URGENT, deadline=deadline, name="emergency")
+
+    # Preemption, used by bulk work at frame boundaries
+
+    def wantsBus(self):
+        """True if bulk work on the gateway thread should step aside now"""
+        return (self._urgent and not self._runningUrgent
+                and threading.current_thread() is self._thread)
+
+    def runUrgent(self):
+        """Send any waiting urgent commands. Only call between SBEP sessions,
+        with the bus idle, from the gateway thread."""
+        if not self.wantsBus():
+            return
+        self.preemptions += 1
+        self._runningUrgent = True
+        try:
+            while True:
+                with self._cond:
+                    if not self._queue or self._queue[0][0] != PRIORITY_URGENT:
+                        return
+                    cmd = heapq.heappop(self._queue)[2]
+                    self._urgent -= 1
+                self._execute(cmd)
+        finally:
+            self._runningUrgent = False
+
+    # Sending
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or not self._running)
+                if not self._queue:
+                    return
+                cmd = heapq.heappop(self._queue)[2]
+                if cmd.priority == PRIORITY_URGENT:
+                    self._urgent -= 1
+            if cmd.priority == PRIORITY_URGENT:
+                self._runningUrgent = True
+                try:
+                    self._execute(cmd)
+                finally:
+                    self._runningUrgent = False
+            else:
+                self._execute(cmd)
+
+    def _execute(self, cmd):
+        cmd.started = time.perf_counter()
+        if cmd.deadline is not None and cmd.started > cmd.deadline:
+            cmd.error = CommandExpired("Command {} waited past its deadline".format(cmd.name))
+            self.expired += 1
+        else:
+            try:
+                cmd.result = cmd.fn(*cmd.args, **cmd.kwargs)
+            except Exception as e:
+                cmd.error = e
+        cmd.finished = time.perf_counter()
+        self.queueLatency[cmd.priority].observe(cmd.queueLatency)
+        self.airLatency[cmd.priority].observe(cmd.airLatency)
+        cmd._done.set()
+
+    # Status
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def collect(self):
+        """Metric families for metrics.Metrics"""
+        return [
+            ("gateway_queue_latency_seconds", "histogram", "Time commands waited in the queue",
+             [({"priority": _PRIORITY_NAMES[p]}, h) for p, h in self.queueLatency.items()]),
+            ("gateway_air_latency_seconds", "histogram", "Time taken sending commands",
+             [({"priority": _PRIORITY_NAMES[p]}, h) for p, h in self.airLatency.items()]),
+            ("gateway_preemptions_total", "counter", "Times bulk SBEP work stepped aside for urgent commands",
+             [({}, self.preemptions)]),
+            ("gateway_expired_total", "counter", "Commands given up on after their deadline",
+             [({}, self.expired)]),
+            ("gateway_pending", "gauge", "Commands waiting to be sent", [({}, self.pending())]),
+        ]
+
+    def close(self, timeout=None):
+        """Send whatever's queued and stop the worker thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self.bus.gateway is self:
+            self.bus.gateway = None
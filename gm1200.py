@@ -21,19 +21,16 @@
 from time import sleep
 from binascii import hexlify, unhexlify
 import sb9600
+import eeprom
+import protocol
 
 # Addressable modules
 MODULE_BCAST =      0
 MODULE_RADIO =      1
 MODULE_FRONTPANEL = 5
 
-# Lamp mappings
-lamps_map = {
-    "L1": 0x0D, "L2RED": 0x0B, "L2GREEN": 0x0C, "L3": 0x01, "L4": 0x02, "L5":
-    0x04, "L5B": 0x05, "L6": 0x10, "L7": 0x07, "L8": 0x11, "L9": 0x12, "L10":
-    0x13, "L11": 0x0E, "L12": 0x0F, "L13": 0x14, "L14": 0x15, "L15": 0x16,
-    "L16": 0x17, "L17": 0x18, "L18": 0x19,
-}
+# Lamp mappings, see protocol.py
+lamps_map = protocol.HEADS['GM1200']['lamps']
 
 # Lamp attributes
 LAMP_OFF =    0
@@ -62,35 +59,49 @@ class GM1200:
   def Reset(self):
     self.bus.sb9600_send(MODULE_BCAST, 0x00, 0x01, 0x08)
 
-  def SBEP(self, module):
-    """Enter SBEP mode"""
-    self.bus.sb9600_send(MODULE_BCAST, 0x12, module, 0x06)
-    self.bus.sbep_enter()
+  def SBEP(self, module, speed=9600):
+    """Enter SBEP mode
 
-  def Display(self, text, offset=0):
-    """Send text to display"""
+    Args:
+      module (int): module to talk to
+      speed (int, optional): baud rate for the session, it must be in
+                             sb9600.SBEP_SPEEDS
+    """
+    code = sb9600.sbep_speed_code(speed)
+    self.bus.sb9600_send(MODULE_BCAST, code, module, 0x06)
+    self.bus.sbep_enter(speed)
+
+  def session(self, module=MODULE_FRONTPANEL, speed=9600):
+    """Start a batch of SBEP operations under one SBEP entry"""
+    return sb9600.SBEPSession(self, module, speed)
+
+  def displayMsg(self, text, offset=0):
+    """Build the SBEP message to send text to the display"""
 
     if len(text) > 14:
       raise ValueError("Text too long!")
 
-    # Build display message
     msg = bytes((0x80, 0x00, len(text), 0x00, offset))
     msg += bytes(text, "ASCII")
     msg += b"\x00" * len(text) # Character attributes
+    return 0x01, msg
 
-    # Send it
-    self.SBEP(MODULE_FRONTPANEL)
-    self.bus.sbep_send(0x01, msg)
-    self.bus.sbep_leave()
-
-  def Lamp(self, lamp, function):
-    """Switch on/off/flash lamp"""
+  def lampMsg(self, lamp, function):
+    """Build the SBEP message to switch on/off/flash a lamp"""
     # If lamp is not an integer, use it as key to look up lampID in map
     if not isinstance(lamp, int):
       lamp = lamps_map[lamp]
-    self.SBEP(MODULE_FRONTPANEL)
-    self.bus.sbep_send(0x21, bytes((0x01, lamp, function)))
-    self.bus.sbep_leave()
+    return 0x21, bytes((0x01, lamp, function))
+
+  def Display(self, text, offset=0):
+    """Send text to display"""
+    with self.session(MODULE_FRONTPANEL) as s:
+      s.display(text, offset)
+
+  def Lamp(self, lamp, function):
+    """Switch on/off/flash lamp"""
+    with self.session(MODULE_FRONTPANEL) as s:
+      s.lamp(lamp, function)
 
   def Illumination(self, illum, level):
     """Change level of illumination"""
@@ -102,43 +113,8 @@ class GM1200:
 
   def ReadEEPROM(self, module, startaddr, endaddr, callback=None):
     """Read EEPROM data. Note: you'll need to reset the radio after this!"""
-    self.CSQ()
-    bus.wait_for_quiet()
-    
-    # Select device? (TODO: What is this?)
-    # You'll need to reset the radio after this command
-    self.bus.sb9600_send(MODULE_BCAST, module, 0x01, 0x08)
-
-    # Must wait some time before entering SBEP mode
-    sleep(0.5)
-    self.SBEP(MODULE_RADIO)
-
-    # Read the data
-    eedata = b''
-    chunklen = 0x40
-    for addr in range(startaddr, endaddr, chunklen):
-      msg = bytes(
-          (chunklen, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF))
-      self.bus.sbep_send(0x11, msg) 
-      op, data = self.bus.sbep_recv()
-      if op==0x80: # Reply is EEPROM data
-        addr_rx = data[0]<<16 | data[1]<<8 | data[2]
-        if addr_rx != addr:
-          raise RuntimeError("Unexpected address in reply addr=0x%x" % addr_rx )
-        if len(data[3:]) != chunklen:
-          raise RuntimeError("Unexpected data length!")
-        eedata += data[3:]
-      else:
-        raise RuntimeError("Unexpected reply op=%d" % op)
-
-      # Notify of progress
-      if callback:
-        callback(addr)
-
-    # Done with SBEP mode
-    self.bus.sbep_leave()
-
-    return eedata
+    reader = eeprom.EEPROMReader(self, module, startaddr, endaddr, callback=callback)
+    return bytes(reader.read())
 
   def Audio(self, enable):
     enable = 1 if enable else 0
@@ -185,15 +161,21 @@ if __name__=="__main__":
     lamps = [[0x14,0x19],[0x15,0x18],[0x16,0x17]] 
     pos = 0
     while True:
-      gm1200.Display(msg[pos:]+msg[0:pos])
+      # One SBEP session per step rather than one per lamp
+      with gm1200.session() as s:
+        s.display(msg[pos:]+msg[0:pos])
+        for l in lamps[0]:
+          s.lamp(l, LAMP_ON)
       pos+=1
       pos%=14
-      for lg in lamps:
-        for l in lg:
-          gm1200.Lamp(l, LAMP_ON)
+      for i, lg in enumerate(lamps):
         sleep(0.1)
-        for l in lg:
-          gm1200.Lamp(l, LAMP_OFF)
+        with gm1200.session() as s:
+          for l in lg:
+            s.lamp(l, LAMP_OFF)
+          if i+1 < len(lamps):
+            for l in lamps[i+1]:
+              s.lamp(l, LAMP_ON)
   except KeyboardInterrupt:
     gm1200.Reset()
 
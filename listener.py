@@ -3,22 +3,72 @@
 #    
 #   the xtl.processMsg() function is where the main handling of messages is done
 #
+#   python listener.py [port] [--capture FILE] [--metrics PORT] [--filter TERMS]
+#
+#   With --capture, every frame is also written to a binary capture file that
+#   replay.py can feed back through the decoder later. With --metrics, bus and
+#   decoder metrics are served in Prometheus format on http://localhost:PORT/
+#   With --filter, only matching frames are decoded (see framefilter.py), e.g.
+#   --filter 00:0a,PANEL:57 for TX state and front panel buttons. Captures
+#   still get everything.
+#
+#   The serial port is drained by a reader thread (see reader.py) which
+#   timestamps everything as it arrives, so slow decoding or printing here
+#   can't hold up reading.
+#
 
+import argparse
+
+import capture
+import framefilter
+import metrics
+import reader
 import sb9600
 import xtl5000
 
-bus = sb9600.Serial("COM2")
-xtl = xtl5000.XTL(bus)
+argp = argparse.ArgumentParser(description="Listen for and decode SB9600/SBEP messages")
+argp.add_argument("port", nargs="?", default="COM2", help="serial port the RIB is on")
+argp.add_argument("--capture", metavar="FILE", help="also record frames to a capture file")
+argp.add_argument("--metrics", metavar="PORT", type=int, help="serve Prometheus metrics on a local port")
+argp.add_argument("--filter", metavar="TERMS", action="append",
+                  help="only decode frames matching these terms, e.g. 00:0a,PANEL:57")
+args = argp.parse_args()
 
+bus = sb9600.Serial(args.port)
+xtl = xtl5000.XTL(bus)
+parser = sb9600.FrameParser()
+cap = capture.CaptureWriter(args.capture) if args.capture else None
+keep = framefilter.FrameFilter(*args.filter) if args.filter else None
 bus.ser.flush()
+busReader = reader.BusReader(bus)
 
-lastBusy = 0
+if args.metrics:
+    registry = metrics.Metrics()
+    registry.add(bus)
+    registry.add(parser)
+    registry.add(xtl)
+    registry.add(busReader)
+    if keep:
+        registry.add(keep)
+    registry.serve(args.metrics)
 
+busReader.start()
 try:
     while True:
-        # Decode serial message
-        if bus.ser.in_waiting > 0:
-            msg = bus.read(bus.ser.in_waiting)
-            xtl.processMsg(msg)
+        # Sleep until something arrives, then split it into frames and decode
+        # them. The timeout just lets Ctrl+C get a look in on an idle bus.
+        item = busReader.get(timeout=0.5)
+        if item is None:
+            continue
+        arrived, chunk = item
+        now = busReader.wallClock(arrived)
+        for sbep, msg in parser.feed(chunk):
+            if cap:
+                cap.write(msg, sbep, now)
+            if keep is None or keep(msg, sbep):
+                xtl.processMsg(msg, sbep, now / 1e9)
 except KeyboardInterrupt:
-    exit(0)
\ No newline at end of file
+    busReader.close()
+    if cap:
+        cap.close()
+    exit(0)
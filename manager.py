@@ -0,0 +1,281 @@
+# Several radios on one host
+#
+# A BusManager owns any number of buses, each with its own frame parser and
+# XTL decoder. One selector thread waits on every port that has a file
+# descriptor and decodes whatever arrives, so an idle bus costs nothing and
+# dozens of radios don't need a core each. Ports that can't be selected on
+# (Windows COM ports, simbus.VirtualPort) get a small reader thread of their
+# own that sleeps in the serial driver instead.
+#
+# Commands go through the manager by radio name. Reading stops on that bus
+# while a command runs, since the send routines read back their own echoes.
+#
+# A frame that a decoder or sink chokes on is logged and dropped. Only a
+# serial error takes a radio off the bus.
+#
+
+import logging
+import selectors
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import sb9600
+import xtl5000
+
+log = logging.getLogger(__name__)
+
+
+class ManagedRadio:
+    """A bus, with the parser and decoder for the radio on it"""
+
+    def __init__(self, name, bus, xtl):
+        self.name = name
+        self.bus = bus
+        self.xtl = xtl
+        self.parser = sb9600.FrameParser()
+        self.fd = None
+        self.frames = 0
+        self.decodeErrors = 0
+        self.error = None
+        # Held while a command has the bus (or the selector thread is reading)
+        self.lock = threading.Lock()
+        self.thread = None
+        # Reader thread handshake: commands waiting for the bus, and whether
+        # the reader is in the middle of a read
+        self.cond = threading.Condition()
+        self.wanted = 0
+        self.reading = False
+
+
+class BusManager:
+    """Receive from and send to several radios from one process
+
+    Usage:
+        mgr = BusManager()
+        mgr.add("north", "/dev/ttyUSB0")
+        mgr.add("south", "/dev/ttyUSB1")
+        mgr.start()
+        mgr.call("north", "Display", "HELLO")
+        with mgr.control("south") as xtl:
+            with xtl.session() as s:
+                s.lamp("L2RED", xtl5000.LAMP_ON)
+        mgr.close()
+    """
+
+    def __init__(self, poll=0.05):
+        """
+        Args:
+            poll (float, optional): longest a reader thread blocks in a read
+                                    (seconds). Ports that support
+                                    cancel_read() let commands in straight
+                                    away, others wait up to this long.
+        """
+        self.poll = poll
+        self.radios = {}
+        self._selector = selectors.DefaultSelector()
+        # Wakes the selector thread when a bus needs watching again
+        self._wakeRecv, self._wakeSend = socket.socketpair()
+        self._wakeRecv.setblocking(False)
+        self._selector.register(self._wakeRecv, selectors.EVENT_READ, None)
+        self._paused = set()
+        self._pausedLock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def add(self, name, port, head='O5', sinks=None, **kwargs):
+        """Add a radio
+
+        Args:
+            name (str): name to refer to it by
+            port (str or sb9600.Serial): serial port, or an opened bus
+            head (str, optional): control head type, as for xtl5000.XTL
+            sinks (list, optional): event sinks for its decoder
+            **kwargs: passed on to sb9600.Serial when opening the port
+
+        Returns:
+            ManagedRadio: the new radio
+        """
+        if name in self.radios:
+            raise ValueError("Radio {} already added".format(name))
+        bus = port if isinstance(port, sb9600.Serial) else sb9600.Serial(port, **kwargs)
+        radio = ManagedRadio(name, bus, xtl5000.XTL(bus, head, sinks))
+        self.radios[name] = radio
+        if self._running:
+            self._watch(radio)
+        return radio
+
+    def __getitem__(self, name):
+        return self.radios[name]
+
+    # Receiving
+
+    def start(self):
+        """Start receiving on every bus"""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._selectLoop, name="BusManager", daemon=True)
+        self._thread.start()
+        for radio in self.radios.values():
+            self._watch(radio)
+
+    def _watch(self, radio):
+        try:
+            radio.fd = radio.bus.ser.fileno()
+        except (AttributeError, OSError):
+            radio.fd = None
+        if radio.fd is None:
+            radio.thread = threading.Thread(target=self._readLoop, args=(radio,),
+                                            name="BusManager-" + radio.name, daemon=True)
+            radio.thread.start()
+        else:
+            self._resume(radio)
+
+    def _resume(self, radio):
+        """Have the selector thread start watching a bus again"""
+        with self._pausedLock:
+            self._paused.add(radio)
+        self._wakeSend.send(b"\0")
+
+    def _received(self, radio, data):
+        now = time.time_ns()
+        for sbep, msg in radio.parser.feed(data):
+            radio.frames += 1
+            try:
+                radio.xtl.processMsg(msg, sbep, now / 1e9)
+            except Exception:
+                radio.decodeErrors += 1
+                log.exception("%s: error handling frame %s", radio.name, bytes(msg).hex())
+
+    def _selectLoop(self):
+        while self._running:
+            for key, events in self._selector.select():
+                radio = key.data
+                if radio is None:
+                    self._wakeRecv.recv(4096)
+                    continue
+                if not radio.lock.acquire(blocking=False):
+                    # A command has the bus, stop watching until it's done
+                    self._selector.unregister(radio.fd)
+                    continue
+                try:
+                    n = radio.bus.ser.in_waiting
+                    if n:
+                        self._received(radio, radio.bus.read(n))
+                except OSError as e:
+                    radio.error = e
+                    self._selector.unregister(radio.fd)
+                    log.error("%s: serial error, no longer reading: %s", radio.name, e)
+                except Exception:
+                    log.exception("%s: error reading", radio.name)
+                finally:
+                    radio.lock.release()
+
+            with self._pausedLock:
+                paused, self._paused = self._paused, set()
+            for radio in paused:
+                if radio.error is None and radio.fd not in self._selector.get_map():
+                    self._selector.register(radio.fd, selectors.EVENT_READ, radio)
+
+    def _readLoop(self, radio):
+        while True:
+            # Stay off the bus while commands want it
+            with radio.cond:
+                radio.cond.wait_for(lambda: not radio.wanted or not self._running)
+                if not self._running:
+                    return
+                radio.reading = True
+            try:
+                data = radio.bus.recv(timeout=self.poll)
+            except OSError as e:
+                radio.error = e
+                data = None
+                log.error("%s: serial error, no longer reading: %s", radio.name, e)
+            finally:
+                with radio.cond:
+                    radio.reading = False
+                    radio.cond.notify_all()
+            if radio.error is not None:
+                return
+            if data:
+                self._received(radio, data)
+
+    def _pauseReader(self, radio):
+        """Get a reader thread off the bus, cutting short any read it's in"""
+        with radio.cond:
+            radio.wanted += 1
+            if radio.reading:
+                cancel = getattr(radio.bus.ser, 'cancel_read', None)
+                if cancel is not None:
+                    cancel()
+            radio.cond.wait_for(lambda: not radio.reading)
+
+    def _resumeReader(self, radio):
+        with radio.cond:
+            radio.wanted -= 1
+            radio.cond.notify_all()
+
+    # Sending
+
+    @contextmanager
+    def control(self, name):
+        """Take a radio's bus for commands, reading resumes afterwards
+
+        Yields:
+            xtl5000.XTL: controller for the radio
+        """
+        radio = self.radios[name]
+        self._pauseReader(radio)
+        try:
+            with radio.lock:
+                # Anything already received belongs to the reader, not to us
+                if radio.fd is not None and radio.bus.ser.in_waiting:
+                    self._received(radio, radio.bus.read(radio.bus.ser.in_waiting))
+                try:
+                    yield radio.xtl
+                finally:
+                    if radio.fd is not None and self._running:
+                        self._resume(radio)
+        finally:
+            self._resumeReader(radio)
+
+    def call(self, name, command, *args, **kwargs):
+        """Run a controller command on a radio
+
+        Args:
+            name (str): radio to send to
+            command (str): XTL method, e.g. "Display" or "sendButton"
+            *args, **kwargs: passed on to the command
+
+        Returns:
+            whatever the command returns
+        """
+        with self.control(name) as xtl:
+            return getattr(xtl, command)(*args, **kwargs)
+
+    # Shutting down
+
+    def close(self):
+        """Stop receiving, and wait for the reader threads to finish"""
+        self._running = False
+        if self._thread is not None:
+            self._wakeSend.send(b"\0")
+            self._thread.join()
+            self._thread = None
+        for radio in self.radios.values():
+            if radio.thread is not None:
+                with radio.cond:
+                    radio.cond.notify_all()
+                radio.thread.join()
+                radio.thread = None
+        self._selector.close()
+        self._wakeRecv.close()
+        self._wakeSend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
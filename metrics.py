@@ -0,0 +1,202 @@
+# Runtime metrics for the bus and decoder
+#
+# sb9600.Serial, sb9600.FrameParser and xtl5000.XTL keep plain counters as
+# they go, which costs next to nothing. Each has a collect() method that
+# turns those counters into metric families, and a Metrics registry gathers
+# them into a snapshot dict or Prometheus text exposition format, served over
+# HTTP or written to a file for the node_exporter textfile collector.
+#
+# A metric family is a tuple of (name, type, help, samples), where type is
+# 'counter', 'gauge' or 'histogram' and samples is a list of (labels, value).
+# labels is a dict, and for histograms the value is a Histogram.
+#
+
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default histogram buckets for bus latencies (seconds)
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Counts of observed values falling into fixed buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            buckets (tuple, optional): upper bounds of the buckets, ascending.
+                                       Anything bigger lands in +Inf.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, count of values <= it) pairs, ending with +Inf"""
+        total = 0
+        out = []
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            total += n
+            out.append((bound, total))
+        return out
+
+
+def _labelText(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Metrics:
+    """Registry of things to collect metrics from
+
+    Usage:
+        m = metrics.Metrics()
+        m.add(bus)
+        m.add(xtl)
+        m.add(parser)
+        m.serve(9100)                  # http://localhost:9100/metrics
+        print(m.snapshot())
+    """
+
+    def __init__(self):
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def add(self, source, **labels):
+        """Collect from something
+
+        Args:
+            source: object with a collect() method, or a callable returning
+                    metric families
+            **labels: extra labels for everything it reports, e.g.
+                      radio="north" when there's more than one bus
+        """
+        collect = getattr(source, "collect", source)
+        with self._lock:
+            self._collectors.append((collect, labels))
+
+    def families(self):
+        """Gather metric families from everything, merging ones with the
+        same name
+
+        Returns:
+            list: (name, type, help, samples) tuples, sorted by name
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+        merged = {}
+        for collect, extra in collectors:
+            for name, kind, text, samples in collect():
+                if extra:
+                    samples = [(dict(labels, **extra), value) for labels, value in samples]
+                if name in merged:
+                    merged[name][3].extend(samples)
+                else:
+                    merged[name] = (name, kind, text, list(samples))
+        return [merged[name] for name in sorted(merged)]
+
+    def snapshot(self):
+        """Current values as a dict
+
+        Unlabelled metrics map straight to their value. Labelled ones map to
+        a dict keyed by the Prometheus-style label text, e.g.
+        '{address="0x05",function="0x57"}'. Histograms become a dict of
+        buckets (cumulative, keyed by upper bound), sum and count.
+
+        Returns:
+            dict: metric name to value
+        """
+        out = {}
+        for name, kind, text, samples in self.families():
+            values = {}
+            for labels, value in samples:
+                if kind == "histogram":
+                    value = {"buckets": {_number(b): n for b, n in value.cumulative()},
+                             "sum": value.sum, "count": value.count}
+                values[_labelText(labels)] = value
+            if list(values) == [""]:
+                values = values[""]
+            out[name] = values
+        return out
+
+    def prometheus(self):
+        """Current values in Prometheus text exposition format
+
+        Returns:
+            str: the exposition text
+        """
+        lines = []
+        for name, kind, text, samples in self.families():
+            lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                if kind == "histogram":
+                    for bound, n in value.cumulative():
+                        le = dict(labels, le=_number(bound))
+                        lines.append("{}_bucket{} {}".format(name, _labelText(le), n))
+                    lines.append("{}_sum{} {}".format(name, _labelText(labels), _number(value.sum)))
+                    lines.append("{}_count{} {}".format(name, _labelText(labels), value.count))
+                else:
+                    lines.append("{}{} {}".format(name, _labelText(labels), _number(value)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the Prometheus text to a file, replacing it atomically so a
+        scraper never sees half of it"""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        """Serve the Prometheus text over HTTP from a background thread
+
+        Args:
+            port (int, optional): port to listen on, 0 picks a free one
+            host (str, optional): address to listen on. Defaults to local
+                                  connections only.
+
+        Returns:
+            http.server.ThreadingHTTPServer: the server, shutdown() it to stop
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+        return server
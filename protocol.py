@@ -0,0 +1,240 @@
+# Protocol descriptions for the radios and control heads
+#
+# Everything we know about addresses, functions and codes lives here as plain
+# data: which SB9600 messages there are and which decoder handles each, and
+# the button, icon, display subdevice and lamp codes for each control head. A
+# head can inherit another's codes and override some of them.
+#
+# load(head) and messages() give a head's codes and the message table
+# compiled into flat lookup tables for decoding (code -> name,
+# address/function -> decoder) and encoding (name -> code). The compiled
+# tables are cached in memory and pickled under __pycache__ keyed by a hash
+# of the description, so they're only rebuilt when the description changes.
+#
+
+import hashlib
+import os
+import pickle
+
+# Bump when the compiled form changes shape
+_COMPILED_VERSION = 1
+
+# SB9600 modules by name
+MODULES = {
+    'BCAST': 0x00,
+    'RADIO': 0x01,
+    'PANEL': 0x05,
+}
+
+# SB9600 messages: (module, function) -> decoder. The decoder is the name of
+# an XTL._decode<name> method, called with (param1, param2, function) and
+# returning (kind, fields) or None. A function of None is the catch-all for
+# any other function sent to that module.
+MESSAGES = {
+    ('BCAST', None): 'UnknownBcast',
+    ('BCAST', 0x06): 'SbepEntry',       # param1 speed code, param2 module
+    ('BCAST', 0x0A): 'ChanState',       # param1 mode (1 monitor, 3 TX), param2 on/off
+    ('PANEL', 0x57): 'Button',          # param1 button code, param2 value
+    ('PANEL', 0x58): 'Illumination',    # param1 target, param2 level
+    ('RADIO', None): 'UnknownRadio',
+    ('RADIO', 0x1D): 'Audio',           # param2 0 muted, 1 unmuted
+    ('RADIO', 0x1E): 'Channel',         # 00 00 idle, xx 03 RX
+    ('RADIO', 0x1F): 'ChanChange',      # param2 channel
+    ('RADIO', 0x60): 'ChanChangeAck',   # param2 channel
+}
+
+# SBEP messages by opcode -> XTL._decode<name> method, called with the
+# message data (no header or checksum)
+SBEP_MESSAGES = {
+    0x01: 'SbepDisplay',
+    0x21: 'SbepIcon',
+}
+
+# Lamps, as found on the GM1200 and used for the XTL too
+_LAMPS = {
+    "L1": 0x0D, "L2RED": 0x0B, "L2GREEN": 0x0C, "L3": 0x01, "L4": 0x02, "L5":
+    0x04, "L5B": 0x05, "L6": 0x10, "L7": 0x07, "L8": 0x11, "L9": 0x12, "L10":
+    0x13, "L11": 0x0E, "L12": 0x0F, "L13": 0x14, "L14": 0x15, "L15": 0x16,
+    "L16": 0x17, "L17": 0x18, "L18": 0x19,
+}
+
+# Control heads. Each has buttons, icons, subdevs (display subdevices) and
+# lamps, as name -> code. 'inherit' takes anything not given from another
+# head.
+HEADS = {
+    'O5': {
+        'buttons': {
+            'ptt': 0x01,
+            'hub': 0x06,
+            'knob_vol': 0x02,
+            'knob_chan': 0x04,
+            'btn_light': 0x54,
+            'btn_dp_lf': 0x80,
+            'btn_home': 0x81,
+            'btn_dp_rg': 0x82,
+            'btn_key_1': 0x83,
+            'btn_key_3': 0x84,
+            'btn_key_5': 0x85,
+            'btn_dp_up': 0x87,
+            'btn_dp_dn': 0x88,
+            'btn_key_2': 0x89,
+            'btn_key_4': 0x8A,
+            'btn_emgcy': 0x94
+        },
+        'icons': {
+            'monitor': 0x01,
+            'scan': 0x04,
+            'direct': 0x07,
+            'led_amber': 0x0f,
+            'led_red': 0x10,
+            'low_power': 0x56
+        },
+        'subdevs': {
+            'text_zone': 0x00,
+            'text_channel': 0x01,
+            'text_softkeys': 0x02
+        },
+        'lamps': _LAMPS,
+    },
+    # The M5 sends the same codes as the O5, see M5-O5-Messaging.txt
+    'M5': {
+        'inherit': 'O5',
+    },
+    'GM1200': {
+        'buttons': {},
+        'icons': {},
+        'subdevs': {},
+        'lamps': _LAMPS,
+    },
+}
+
+_TABLES = ('buttons', 'icons', 'subdevs', 'lamps')
+
+
+class Compiled:
+    """Flat lookup tables for one head
+
+    Attributes:
+        head (str): head name
+        buttons, icons, subdevs, lamps (dict): name -> code, for encoding
+        buttonNames, iconNames, subdevNames, lampNames (dict): code -> name,
+                                                               for decoding
+    """
+
+    def __init__(self, head, tables):
+        self.head = head
+        for name in _TABLES:
+            setattr(self, name, tables[name])
+            setattr(self, name[:-1] + "Names", {v: k for k, v in tables[name].items()})
+
+
+class CompiledMessages:
+    """Flat lookup tables for the messages, the same for every head
+
+    Attributes:
+        moduleNames (dict): SB9600 module code -> name
+        decoders (dict): address << 8 | function -> decoder name, with every
+                         function filled in for modules with a catch-all
+        sbepDecoders (dict): SBEP opcode -> decoder name
+    """
+
+    def __init__(self):
+        self.moduleNames = {v: k for k, v in MODULES.items()}
+        self.decoders = {}
+        for (module, function), decoder in MESSAGES.items():
+            if function is None:
+                address = MODULES[module] << 8
+                for f in range(256):
+                    self.decoders[address | f] = decoder
+        for (module, function), decoder in MESSAGES.items():
+            if function is not None:
+                self.decoders[MODULES[module] << 8 | function] = decoder
+        self.sbepDecoders = dict(SBEP_MESSAGES)
+
+
+def _resolve(head, seen=()):
+    """A head's tables with inheritance applied"""
+    if head in seen:
+        raise ValueError("Head {} inherits from itself".format(head))
+    spec = HEADS[head]
+    tables = _resolve(spec['inherit'], seen + (head,)) if 'inherit' in spec else {t: {} for t in _TABLES}
+    for name in _TABLES:
+        if name in spec:
+            tables[name] = dict(tables[name], **spec[name])
+    return tables
+
+
+def compileHead(head):
+    """Compile a head's description into lookup tables
+
+    Raises:
+        ValueError: if the head isn't described
+    """
+    if head not in HEADS:
+        raise ValueError("Invalid head specified")
+    return Compiled(head, _resolve(head))
+
+
+def _cachePath():
+    spec = repr((_COMPILED_VERSION, MODULES, MESSAGES, SBEP_MESSAGES, HEADS))
+    digest = hashlib.sha1(spec.encode()).hexdigest()[:16]
+    here = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(here, "__pycache__", "protocol-{}.pickle".format(digest))
+
+
+_compiled = None
+
+
+def _load():
+    """Everything compiled, from memory, the disk cache or by compiling"""
+    global _compiled
+    if _compiled is not None:
+        return _compiled
+
+    path = _cachePath()
+    try:
+        with open(path, "rb") as f:
+            _compiled = pickle.load(f)
+        return _compiled
+    except (OSError, pickle.PickleError, EOFError, AttributeError, ValueError):
+        pass
+
+    # Compile everything and cache it for next time
+    _compiled = {
+        'messages': CompiledMessages(),
+        'heads': {head: compileHead(head) for head in HEADS},
+    }
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}".format(path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(_compiled, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        # Read-only install, just compile each run
+        pass
+    return _compiled
+
+
+def load(head):
+    """Compiled tables for a head
+
+    Raises:
+        ValueError: if the head isn't described
+
+    Returns:
+        Compiled: the tables
+    """
+    heads = _load()['heads']
+    if head not in heads:
+        raise ValueError("Invalid head specified")
+    return heads[head]
+
+
+def messages():
+    """Compiled message tables
+
+    Returns:
+        CompiledMessages: the tables
+    """
+    return _load()['messages']
@@ -0,0 +1,161 @@
+# Serial reading decoupled from decoding
+#
+# A BusReader thread does nothing but drain the serial port into a bounded
+# queue, stamping each chunk with perf_counter_ns() as it comes in. Decoding,
+# printing and whatever else runs on the consumer side, so a slow console or
+# a burst of SBEP display updates can't stall the reads and let the driver's
+# buffer overflow, and timestamps reflect when bytes arrived rather than when
+# we got round to them.
+#
+# If the consumer falls behind for long enough to fill the queue, the oldest
+# chunks are thrown away and counted. The frame parser resyncs on the next
+# good frame.
+#
+
+import threading
+import time
+from collections import deque
+from time import perf_counter_ns
+
+import metrics
+
+
+class BusReader:
+    """Background thread draining a bus into a bounded queue
+
+    The reader must be the only thing reading the bus while it runs, so it
+    suits listening rather than sending commands.
+
+    Usage:
+        reader = BusReader(bus)
+        reader.start()
+        while True:
+            item = reader.get(timeout=0.5)
+            if item is None:
+                continue
+            arrived, chunk = item
+            for sbep, msg in parser.feed(chunk):
+                xtl.processMsg(msg, sbep, reader.wallClock(arrived) / 1e9)
+    """
+
+    def __init__(self, bus, maxChunks=1024, poll=0.2):
+        """
+        Args:
+            bus (sb9600.Serial): bus to read
+            maxChunks (int, optional): chunks to hold before dropping the
+                                       oldest
+            poll (float, optional): longest to block in the serial driver
+                                    before checking for close() (seconds)
+        """
+        self.bus = bus
+        self.maxChunks = maxChunks
+        self.poll = poll
+
+        # Counters, see collect()
+        self.chunks = 0
+        self.bytes = 0
+        self.droppedChunks = 0
+        self.droppedBytes = 0
+        self.highWater = 0
+        # Time from a chunk arriving to the consumer taking it
+        self.queueLatency = metrics.Histogram()
+        self.error = None
+
+        # perf_counter_ns() is only good for intervals, this turns it into
+        # wall clock time
+        self._clockOffset = time.time_ns() - perf_counter_ns()
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="BusReader", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            try:
+                data = self.bus.recv(timeout=self.poll)
+            except Exception as e:
+                self.error = e
+                with self._cond:
+                    self._running = False
+                    self._cond.notify_all()
+                return
+            if not data:
+                continue
+            arrived = perf_counter_ns()
+            with self._cond:
+                self.chunks += 1
+                self.bytes += len(data)
+                if len(self._queue) >= self.maxChunks:
+                    _, lost = self._queue.popleft()
+                    self.droppedChunks += 1
+                    self.droppedBytes += len(lost)
+                self._queue.append((arrived, data))
+                if len(self._queue) > self.highWater:
+                    self.highWater = len(self._queue)
+                self._cond.notify()
+
+    def get(self, timeout=None):
+        """Take the next chunk
+
+        Args:
+            timeout (float, optional): seconds to wait. Defaults to forever.
+
+        Returns:
+            (int, bytes): perf_counter_ns() arrival time and the bytes, or None
+                          if nothing arrived in time
+
+        Raises:
+            Exception: whatever stopped the reader thread, once the queue is
+                       empty
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queue or not self._running, timeout):
+                return None
+            if not self._queue:
+                if self.error is not None:
+                    raise self.error
+                return None
+            arrived, data = self._queue.popleft()
+        self.queueLatency.observe((perf_counter_ns() - arrived) / 1e9)
+        return arrived, data
+
+    def wallClock(self, arrived):
+        """Convert an arrival time to wall clock time
+
+        Returns:
+            int: nanoseconds since the epoch, as time.time_ns()
+        """
+        return arrived + self._clockOffset
+
+    def pending(self):
+        with self._cond:
+            return len(self._queue)
+
+    def collect(self):
+        """Metric families for metrics.Metrics"""
+        return [
+            ("reader_chunks_total", "counter", "Chunks read from the serial port", [({}, self.chunks)]),
+            ("reader_bytes_total", "counter", "Bytes read from the serial port", [({}, self.bytes)]),
+            ("reader_dropped_chunks_total", "counter", "Chunks thrown away because the queue was full",
+             [({}, self.droppedChunks)]),
+            ("reader_dropped_bytes_total", "counter", "Bytes thrown away because the queue was full",
+             [({}, self.droppedBytes)]),
+            ("reader_queue_depth", "gauge", "Chunks waiting to be decoded", [({}, self.pending())]),
+            ("reader_queue_high_water", "gauge", "Most chunks that have been waiting at once",
+             [({}, self.highWater)]),
+            ("reader_queue_latency_seconds", "histogram", "Time chunks waited before being decoded",
+             [({}, self.queueLatency)]),
+        ]
+
+    def close(self, timeout=None):
+        """Stop the reader thread. Chunks already queued can still be taken."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,37 @@
+#
+#   This script replays a capture made with listener.py --capture through the
+#   decoder, either at the original timing or as fast as it can go
+#
+#   python replay.py capture.sbc [--realtime] [--speed N] [--quiet] [--filter TERMS]
+#
+
+import argparse
+import time
+
+import capture
+import framefilter
+import xtl5000
+
+parser = argparse.ArgumentParser(description="Replay an SB9600 capture through the decoder")
+parser.add_argument("capture", help="capture file written by listener.py --capture")
+parser.add_argument("--realtime", action="store_true", help="keep the original timing between frames")
+parser.add_argument("--speed", type=float, default=1.0, help="speed-up factor for --realtime")
+parser.add_argument("--quiet", action="store_true", help="decode without printing anything, for timing the decoder")
+parser.add_argument("--head", default="O5", help="control head type")
+parser.add_argument("--filter", metavar="TERMS", action="append",
+                    help="only decode frames matching these terms, see framefilter.py")
+args = parser.parse_args()
+
+xtl = xtl5000.XTL(None, head=args.head, sinks=[] if args.quiet else None)
+keep = framefilter.FrameFilter(*args.filter) if args.filter else None
+
+with capture.CaptureReader(args.capture) as reader:
+    start = time.perf_counter()
+    try:
+        count = capture.replay(reader, xtl, realtime=args.realtime, speed=args.speed,
+                               frameFilter=keep)
+    except KeyboardInterrupt:
+        exit(0)
+    elapsed = time.perf_counter() - start
+
+print("Replayed {} frames in {:.3f}s ({:.0f} frames/sec)".format(count, elapsed, count / elapsed if elapsed else 0))
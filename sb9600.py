@@ -7,9 +7,43 @@
 # NOTE: This protocol may be patented by Motorola. Use at your own risk.
 #
 
+import random
 import serial
-from time import sleep
-from binascii import hexlify
+from time import perf_counter, perf_counter_ns, sleep
+
+import metrics
+
+# SBEP speed codes, sent as param1 of the broadcast SBEP entry command (0x06)
+# and keyed by baud rate. Only 9600 has been seen on the wire so far. If you
+# find the code for a faster rate, add it here (or at runtime) and it can be
+# requested with SBEP(module, speed=<baud>).
+SBEP_SPEEDS = {
+    9600: 0x12,
+}
+
+
+class BusTimeout(RuntimeError):
+    """The bus stayed BUSY for longer than we were prepared to wait"""
+
+
+def sbep_speed_code(baud):
+    """Look up the SBEP entry speed code for a baud rate
+
+    Raises:
+        ValueError: if there's no known code for the rate
+    """
+    try:
+        return SBEP_SPEEDS[baud]
+    except KeyError:
+        raise ValueError("No known SBEP speed code for {} baud".format(baud))
+
+
+def sbep_speed_baud(code):
+    """Baud rate for an SBEP entry speed code, or None if it isn't known"""
+    for baud, c in SBEP_SPEEDS.items():
+        if c == code:
+            return baud
+    return None
 
 # Polynomial=0x1f, reflected
 # NOTE: This table was derived from looking at examples sniffed off the wire
@@ -59,16 +93,461 @@ def sbep_CRC(data):
     return crc
 
 
+def sb9600_frame(address, param1, param2, function):
+    """Build an SB9600 message with its CRC byte appended"""
+    msg = bytes((address, param1, param2, function))
+    return msg + bytes([sb9600_CRC(msg)])
+
+
+class FrameCache:
+    """Ready-built SB9600 frames, CRC included
+
+    Commands that get sent over and over (button presses, knob clicks) are
+    built once and then written straight out. The frame doubles as the echo
+    to check for, so there's nothing left to do per send.
+
+    Usage:
+        frames = sb9600.frame_cache.precompute(0x05, 0x57, (0x01,), (0, 1))
+        bus.send_frame(frames[(0x01, 1)])
+    """
+
+    def __init__(self, maxsize=4096):
+        """
+        Args:
+            maxsize (int, optional): most frames to keep. Once full, frames
+                                     not already cached are built each time.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._frames = {}
+
+    def frame(self, address, param1, param2, function):
+        """Get a frame, building and caching it if it's new
+
+        Raises:
+            ValueError: if a field doesn't fit in a byte
+        """
+        key = (address, param1, param2, function)
+        msg = self._frames.get(key)
+        if msg is not None:
+            self.hits += 1
+            return msg
+        self.misses += 1
+        msg = sb9600_frame(address, param1, param2, function)
+        if len(self._frames) < self.maxsize:
+            self._frames[key] = msg
+        return msg
+
+    def precompute(self, address, function, param1s, param2s):
+        """Build the frames for every combination of parameters
+
+        Args:
+            address (int): module address
+            function (int): function code
+            param1s (iterable): param1 values
+            param2s (iterable): param2 values
+
+        Returns:
+            dict: (param1, param2) -> frame
+        """
+        param2s = tuple(param2s)
+        return {(p1, p2): self.frame(address, p1, p2, function)
+                for p1 in param1s for p2 in param2s}
+
+    def __len__(self):
+        return len(self._frames)
+
+
+# Shared by everything, frames don't depend on the bus they go out on
+frame_cache = FrameCache()
+
+
+def sbep_frame(opcode, data):
+    """Build an SBEP message with its header and checksum"""
+    # Data length including CRC
+    datalen = len(data) + 1
+
+    # Determine where OP code is in header
+    hdr = 0
+    if opcode >= 0xF:
+        hdr |= 0xF0
+        extop = opcode
+    else:
+        hdr |= (opcode << 4)
+        extop = None
+
+    # Determine where length code is in header
+    if datalen >= 0xF:
+        hdr |= 0x0F
+        extlen = datalen
+        if not extop:
+            extop = 0
+    else:
+        hdr |= datalen & 0xF
+        extlen = None
+
+    # Build message
+    msg = bytes((hdr,))
+    if extop is not None:
+        msg += bytes((extop,))
+    if extlen is not None:
+        msg += bytes((extlen,))
+    msg += data
+    msg += bytes((sbep_CRC(msg),))
+    return msg
+
+
+def sbep_parse(msg):
+    """Split a complete SBEP message into its opcode and data
+
+    Args:
+        msg (bytes): SBEP message including header and checksum
+
+    Raises:
+        RuntimeError: if the checksum is bad
+
+    Returns:
+        (int, bytes): opcode and data without the checksum
+    """
+    if sbep_CRC(msg):
+        raise RuntimeError("SBEP checksum failed")
+
+    hdr = msg[0]
+    pos = 1
+    op = (hdr >> 4) & 0xF
+    if op == 0xF:
+        op = msg[pos]
+        pos += 1
+    if hdr & 0xF == 0xF:
+        if op != 0xF:
+            pos += 1
+        pos += 1
+    return op, msg[pos:-1]
+
+
+def sbep_length(buf, start, count):
+    """Work out the total length of the SBEP message at buf[start]
+
+    The header is decoded the same way as Serial.sbep_recv().
+
+    Args:
+        buf (bytearray): receive buffer
+        start (int): index of the header byte
+        count (int): number of valid bytes from start
+
+    Returns:
+        int: total message length including header and checksum, or None if
+             more bytes are needed to tell
+    """
+    hdr = buf[start]
+    pos = 1
+    op = (hdr >> 4) & 0xF
+    datalen = hdr & 0xF
+
+    if op == 0xF:
+        if count <= pos:
+            return None
+        op = buf[start + pos]
+        pos += 1
+
+    if datalen == 0xF:
+        if op != 0xF:
+            pos += 1
+        if count <= pos:
+            return None
+        datalen = buf[start + pos]
+        pos += 1
+
+    return pos + datalen
+
+
+class FrameParser:
+    """Incremental SB9600/SBEP frame parser
+
+    Bytes are fed in whatever chunks the serial port hands over. Frames are
+    found by checking the SB9600 CRC / SBEP checksum, so split, merged or
+    corrupted reads resynchronise on their own. The parser also follows SBEP
+    entry commands on the bus, so it knows which framing to expect next.
+
+    Received bytes go into a mirrored ring buffer (every byte is stored twice,
+    size bytes apart) so any frame can be handed out as one contiguous
+    memoryview without copying.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.buf = bytearray(size * 2)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.count = 0
+        self.inSBEP = False
+        self.frames = 0
+        self.sbepFrames = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self._dropping = False
+        # Called as tracer('parse', start_ns, end_ns, frame) for each frame
+        # found, timing the search for it. See tracing.py.
+        self.tracer = None
+
+    def reset(self):
+        """Discard any buffered bytes and go back to SB9600 framing"""
+        self.start = 0
+        self.count = 0
+        self.inSBEP = False
+
+    def feed(self, data):
+        """Add received bytes and yield any frames that are now complete
+
+        Frames are memoryviews into the ring buffer and are only valid until
+        the next frame is requested. Use bytes(frame) to keep one.
+
+        Args:
+            data (bytes): bytes read from the bus
+
+        Yields:
+            (bool, memoryview): True if the frame is an SBEP message, and the
+                                frame itself including its CRC/checksum
+        """
+        if self.tracer is not None:
+            yield from self._tracedFeed(data)
+            return
+        data = memoryview(data)
+        while len(data):
+            n = min(len(data), self.size - self.count)
+            self._put(data[:n])
+            data = data[n:]
+            yield from self._frames()
+
+    def _tracedFeed(self, data):
+        tracer = self.tracer
+        data = memoryview(data)
+        start = perf_counter_ns()
+        while len(data):
+            n = min(len(data), self.size - self.count)
+            self._put(data[:n])
+            data = data[n:]
+            for frame in self._frames():
+                tracer('parse', start, perf_counter_ns(), frame[1])
+                yield frame
+                # Don't count the time the caller spent on the frame
+                start = perf_counter_ns()
+
+    def _put(self, data):
+        """Copy bytes into the free part of the ring"""
+        size = self.size
+        pos = (self.start + self.count) % size
+        n = min(len(data), size - pos)
+        self.buf[pos:pos + n] = data[:n]
+        self.buf[pos + size:pos + size + n] = data[:n]
+        if n < len(data):
+            rest = len(data) - n
+            self.buf[0:rest] = data[n:]
+            self.buf[size:size + rest] = data[n:]
+        self.count += len(data)
+
+    def _consume(self, n):
+        self.start = (self.start + n) % self.size
+        self.count -= n
+
+    def _sb9600Valid(self, s):
+        return sb9600_CRC(self.view[s:s + 4]) == self.buf[s + 4]
+
+    def _frames(self):
+        buf = self.buf
+        view = self.view
+        while self.count:
+            s = self.start
+
+            if self.inSBEP:
+                # ACK from the module we're talking to
+                if buf[s] == 0x50:
+                    self._consume(1)
+                    continue
+                n = sbep_length(buf, s, self.count)
+                if n is not None and n <= self.count:
+                    if n < 5 and self.count < 5:
+                        # Could be the start of an SB9600 frame, wait until
+                        # there's enough to check its CRC
+                        return
+                    valid = not sbep_CRC(view[s:s + n])
+                    if valid and self.count >= 5 and self._sb9600Valid(s):
+                        # Both checks pass, so one of them matched by chance.
+                        # The module ACKs real SBEP messages, so go by the
+                        # byte after it.
+                        if self.count == n:
+                            return
+                        valid = buf[s + n] == 0x50
+                    if valid:
+                        self._consume(n)
+                        self.frames += 1
+                        self.sbepFrames += 1
+                        self._dropping = False
+                        yield True, view[s:s + n]
+                        continue
+                    # Not a valid SBEP message, must be back to SB9600
+                    self.inSBEP = False
+                elif self.count >= 5 and self._sb9600Valid(s):
+                    # Still waiting on an SBEP message but there's a good
+                    # SB9600 frame sitting here, so SBEP mode has finished
+                    self.inSBEP = False
+                elif n is None or n <= self.size:
+                    return
+                else:
+                    self.inSBEP = False
+
+            if self.count < 5:
+                return
+            if not self._sb9600Valid(s):
+                # Garbage, slide along a byte and try again
+                self._consume(1)
+                self.dropped += 1
+                if not self._dropping:
+                    # Count each run of garbage as one failed CRC
+                    self._dropping = True
+                    self.resyncs += 1
+                continue
+
+            # Broadcast SBEP entry command, SBEP message follows
+            if buf[s] == 0x00 and buf[s + 3] == 0x06:
+                self.inSBEP = True
+            self._consume(5)
+            self.frames += 1
+            self._dropping = False
+            yield False, view[s:s + 5]
+
+    def collect(self):
+        """Metric families for metrics.Metrics"""
+        return [
+            ("sb9600_frames_parsed_total", "counter", "Frames found in the received bytes",
+             [({"type": "sb9600"}, self.frames - self.sbepFrames), ({"type": "sbep"}, self.sbepFrames)]),
+            ("sb9600_crc_failures_total", "counter", "Runs of bytes that failed the CRC and were skipped",
+             [({}, self.resyncs)]),
+            ("sb9600_bytes_dropped_total", "counter", "Bytes skipped while resynchronising",
+             [({}, self.dropped)]),
+        ]
+
+
+class SBEPSession:
+    """Batch of SBEP operations sent to a module under one SBEP entry
+
+    Entering SBEP mode costs an SB9600 entry command and an ACK round trip,
+    so sending several display/lamp/icon updates in one session is much
+    quicker than entering and leaving for each of them.
+
+    Usage:
+        with xtl.session(xtl5000.MODULE_FRONTPANEL) as s:
+            s.display("HELLO")
+            s.lamp("L2RED", xtl5000.LAMP_ON)
+    """
+
+    def __init__(self, ctrl, module, speed=9600):
+        """
+        Args:
+            ctrl: controller (xtl5000.XTL, gm1200.GM1200) that builds the
+                  messages and owns the bus
+            module (int): module address to talk to
+            speed (int, optional): baud rate for the session, see SBEP_SPEEDS
+        """
+        self.ctrl = ctrl
+        self.bus = ctrl.bus
+        self.module = module
+        self.speed = speed
+        self.ops = 0
+
+    def __enter__(self):
+        self.ctrl.SBEP(self.module, self.speed)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.bus.sbep_leave()
+        # We no longer know what made it to the display
+        if exc_type is not None and hasattr(self.ctrl, 'invalidateDisplay'):
+            self.ctrl.invalidateDisplay()
+
+    def send(self, opcode, data):
+        """Send a raw SBEP message in the session"""
+        gateway = self.bus.gateway
+        if gateway is not None and gateway.wantsBus():
+            # Step out of SBEP mode for urgent commands, then carry on
+            self.bus.sbep_leave()
+            gateway.runUrgent()
+            self.ctrl.SBEP(self.module, self.speed)
+        self.bus.sbep_send(opcode, data)
+        self.ops += 1
+
+    def display(self, *args, **kwargs):
+        """Send text to the display, see the controller's Display()"""
+        msg = self.ctrl.displayMsg(*args, **kwargs)
+        if msg is not None:
+            self.send(*msg)
+            if hasattr(self.ctrl, 'displaySent'):
+                self.ctrl.displaySent(*msg)
+
+    def lamp(self, lamp, function):
+        """Switch on/off/flash a lamp"""
+        self.send(*self.ctrl.lampMsg(lamp, function))
+
+    def icon(self, icon, function):
+        """Switch on/off/flash a display icon"""
+        self.send(*self.ctrl.iconMsg(icon, function))
+
+
 class Serial:
     """SB9600 serial routines"""
 
-    def __init__(self, port="/dev/ttyUSB0", busy_is_RTS=False):
-
-        # Open serial port
-        self.ser = serial.Serial(port,
-                                 baudrate=9600,
-                                 rtscts=0,
-                                 timeout=0.2)
+    # SB9600 itself always runs at this speed, only SBEP sessions change it
+    baudrate = 9600
+
+    def __init__(self, port="/dev/ttyUSB0", busy_is_RTS=False, busy_timeout=2.0,
+                 retries=3, backoff=0.005):
+        """
+        Args:
+            port (str or serial port, optional): serial device to open, or an
+                                                 already open port
+            busy_is_RTS (bool, optional): drive BUSY with RTS instead of DTR
+            busy_timeout (float, optional): longest to wait for someone else
+                                            to release BUSY (seconds)
+            retries (int, optional): times to resend an SB9600 message that
+                                     collided with another one
+            backoff (float, optional): base of the random backoff before
+                                       resending, doubled on each retry
+        """
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        # Bus access counters
+        self.busyWaitTime = 0.0
+        self.busyTimeouts = 0
+        self.collisions = 0
+        self.retransmits = 0
+
+        # Traffic counters, see collect()
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.messagesSent = 0
+        self.sendLatency = metrics.Histogram()
+        self.started = perf_counter()
+
+        # Called as tracer(stage, start_ns, end_ns, info) around each stage of
+        # sending and receiving, see tracing.py. None costs nothing.
+        self.tracer = None
+
+        # gateway.CommandGateway driving this bus, if any. Long SBEP work
+        # checks it between frames for urgent commands to let through.
+        self.gateway = None
+
+        # Open serial port, or use one that's already been set up (e.g. a
+        # simbus.VirtualPort)
+        if isinstance(port, str):
+            self.ser = serial.Serial(port,
+                                     baudrate=self.baudrate,
+                                     rtscts=0,
+                                     timeout=0.2)
+        else:
+            self.ser = port
 
         # Pick BUSY line | useful for some USB->TTL adaptors like FTDI's TTLUSB5V
         #                | that don't give you a DTR line to use!
@@ -81,118 +560,269 @@ class Serial:
         self.busy(0)
 
     def write(self, msg):
-        #print("SEND: %s" % hexlify(msg))
-        self.ser.write(msg)
+        if self.tracer is None:
+            self.ser.write(msg)
+        else:
+            start = perf_counter_ns()
+            self.ser.write(msg)
+            self.tracer('write', start, perf_counter_ns(), msg)
+        self.bytesSent += len(msg)
 
     def read(self, msglen):
-        msg = self.ser.read(msglen)
-        #print("RECV: %s" % hexlify(msg, ' '))
+        if self.tracer is None:
+            msg = self.ser.read(msglen)
+        else:
+            start = perf_counter_ns()
+            msg = self.ser.read(msglen)
+            self.tracer('read', start, perf_counter_ns(), msg)
+        self.bytesReceived += len(msg)
+        return msg
+
+    def _echo(self, msg):
+        """Read back a message we've just sent, True if it came back intact"""
+        if self.tracer is None:
+            msgchk = self.ser.read(len(msg))
+        else:
+            start = perf_counter_ns()
+            msgchk = self.ser.read(len(msg))
+            self.tracer('echo', start, perf_counter_ns(), msgchk)
+        self.bytesReceived += len(msgchk)
+        return msgchk == msg
+
+    def recv(self, minlen=1, interbyte=None, timeout=None):
+        """Block until bytes arrive on the bus and return them
+
+        Sleeps in the serial driver rather than polling in_waiting, so an idle
+        bus costs no CPU.
+
+        Args:
+            minlen (int, optional): wait for at least this many bytes
+            interbyte (float, optional): once the first byte is in, keep reading
+                                         until the line has been quiet this long
+                                         (seconds). Defaults to returning as
+                                         soon as minlen bytes are in.
+            timeout (float, optional): give up after this many seconds and
+                                       return whatever arrived. Defaults to
+                                       waiting forever.
+
+        Returns:
+            bytes: received bytes, empty if the timeout expired first
+        """
+        told = self.ser.timeout
+        itold = self.ser.inter_byte_timeout
+        self.ser.timeout = timeout
+        self.ser.inter_byte_timeout = None
+        try:
+            msg = self.ser.read(minlen)
+            if self.tracer is not None:
+                # Time from the first bytes arriving, not the idle wait
+                start = perf_counter_ns()
+            if msg and interbyte is not None:
+                # Keep going until the line goes quiet
+                self.ser.timeout = interbyte
+                while True:
+                    more = self.ser.read(max(self.ser.in_waiting, 1))
+                    if not more:
+                        break
+                    msg += more
+        finally:
+            self.ser.timeout = told
+            self.ser.inter_byte_timeout = itold
+        # Grab anything else that came in alongside
+        if msg and self.ser.in_waiting:
+            msg += self.ser.read(self.ser.in_waiting)
+        self.bytesReceived += len(msg)
+        if self.tracer is not None and msg:
+            self.tracer('read', start, perf_counter_ns(), msg)
         return msg
 
     def wait_for_quiet(self, time=0.5):
-        told = self.ser.getTimeout()
-        self.ser.setTimeout(time)
-        while self.ser.read(1) != b'':
+        told = self.ser.timeout
+        self.ser.timeout = time
+        while self.read(1) != b'':
             pass
-        self.ser.setTimeout(told)
+        self.ser.timeout = told
+
+    def wait_not_busy(self, timeout=None):
+        """Wait for the BUSY line to drop, sleeping rather than spinning
+
+        Polls CTS with a backoff from 0.5ms up to 10ms, so a short wait
+        between messages stays quick but a long one costs next to no CPU.
+
+        Args:
+            timeout (float, optional): seconds to wait. Defaults to
+                                       busy_timeout.
+
+        Raises:
+            BusTimeout: if BUSY is still asserted after the timeout
+        """
+        if self.tracer is None:
+            self._waitNotBusy(timeout)
+            return
+        start = perf_counter_ns()
+        try:
+            self._waitNotBusy(timeout)
+        finally:
+            self.tracer('busy_wait', start, perf_counter_ns(), None)
+
+    def _waitNotBusy(self, timeout):
+        if not self.isBusy():
+            return
+        if timeout is None:
+            timeout = self.busy_timeout
+        start = perf_counter()
+        deadline = start + timeout
+        delay = 0.0005
+        try:
+            while self.isBusy():
+                now = perf_counter()
+                if now >= deadline:
+                    self.busyTimeouts += 1
+                    raise BusTimeout("Timed out waiting for BUSY to drop")
+                sleep(min(delay, deadline - now))
+                delay = min(delay * 2, 0.01)
+        finally:
+            self.busyWaitTime += perf_counter() - start
+
+    def collided(self, attempt):
+        """Count a collision and back off before resending
+
+        Args:
+            attempt (int): retries made so far for this message
+
+        Returns:
+            bool: True to resend, False if out of retries
+        """
+        self.collisions += 1
+        if attempt >= self.retries:
+            return False
+        self.retransmits += 1
+        # Random, so two masters that collided don't just do it again
+        sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+        return True
 
     def sb9600_send(self, address, param1, param2, function):
-        """Send an sb9600 formatted message"""
-
-        # Build message
-        msg = bytes((address, param1, param2, function))
-        msg = msg + bytes([sb9600_CRC(msg)])
-
-        print(" SENT>: {}".format(hexlify(msg, ' ')))
-
-        # Wait until not busy
-        while self.isBusy():
-            pass
-
-        # Assert BUSY and send message
-        self.busy(1)
-        self.ser.flushInput()
-        self.write(msg)
-        self.ser.flush()
-
-        # Check our message got sent properly
-        msgchk = self.ser.read(len(msg))
-        if msgchk != msg:
-            raise RuntimeError("Message was not sent properly!")
-
-        # De-assert BUSY and wait for bus to be free
-        self.busy(0)
-        #while self.isBusy():
-        #    pass
-
-    def sbep_enter(self):
-        """Enter SBEP mode after sending entry command"""
-        print("Entering SBEP mode")
+        """Send an sb9600 formatted message
+
+        If someone else talks at the same time (our echo comes back wrong) the
+        message is resent after a random backoff, up to 'retries' times.
+
+        Raises:
+            BusTimeout: if the bus doesn't come free in time
+            RuntimeError: if the message still can't be sent after retrying
+        """
+
+        self.send_frame(frame_cache.frame(address, param1, param2, function))
+
+    def send_frame(self, msg):
+        """Send a ready-built SB9600 frame, see FrameCache
+
+        Raises:
+            BusTimeout: if the bus doesn't come free in time
+            RuntimeError: if the message still can't be sent after retrying
+        """
+        began = perf_counter()
+        attempt = 0
+        while True:
+            # Wait until not busy
+            self.wait_not_busy()
+
+            # Assert BUSY and send message
+            self.busy(1)
+            try:
+                self.ser.flushInput()
+                self.write(msg)
+                self.ser.flush()
+
+                # Check our message got sent properly
+                sent = self._echo(msg)
+            finally:
+                # De-assert BUSY
+                self.busy(0)
+
+            if sent:
+                # From starting to wait for the bus to hearing it back
+                self.sendLatency.observe(perf_counter() - began)
+                self.messagesSent += 1
+                return
+            if not self.collided(attempt):
+                raise RuntimeError("Message was not sent properly!")
+            attempt += 1
+
+    def utilisation(self):
+        """Fraction of the time since the bus was opened that the line has
+        been carrying bytes we've heard (including our own)"""
+        elapsed = perf_counter() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return min(self.bytesReceived * 10 / self.baudrate / elapsed, 1.0)
+
+    def collect(self):
+        """Metric families for metrics.Metrics"""
+        return [
+            ("sb9600_bytes_sent_total", "counter", "Bytes written to the bus", [({}, self.bytesSent)]),
+            ("sb9600_bytes_received_total", "counter", "Bytes read from the bus, including our own echoes",
+             [({}, self.bytesReceived)]),
+            ("sb9600_bus_utilisation", "gauge", "Fraction of time the bus has been carrying bytes",
+             [({}, self.utilisation())]),
+            ("sb9600_messages_sent_total", "counter", "SB9600 messages sent and verified",
+             [({}, self.messagesSent)]),
+            ("sb9600_send_latency_seconds", "histogram",
+             "SB9600 send time from waiting for BUSY to a verified echo", [({}, self.sendLatency)]),
+            ("sb9600_busy_wait_seconds_total", "counter", "Time spent waiting for BUSY to drop",
+             [({}, self.busyWaitTime)]),
+            ("sb9600_busy_timeouts_total", "counter", "Waits for BUSY that timed out",
+             [({}, self.busyTimeouts)]),
+            ("sb9600_collisions_total", "counter", "SB9600 sends whose echo came back wrong",
+             [({}, self.collisions)]),
+            ("sb9600_retransmits_total", "counter", "SB9600 messages resent after a collision",
+             [({}, self.retransmits)]),
+        ]
+
+    def sbep_enter(self, speed=9600):
+        """Enter SBEP mode after sending entry command
+
+        Args:
+            speed (int, optional): baud rate requested in the entry command.
+                                   The port is switched to it once the radio
+                                   has ACKed, and back on sbep_leave().
+        """
         # wait for BUSY to drop
-        while self.isBusy():
-            pass
+        self.wait_not_busy()
         # set BUSY
         self.busy(1)
-        # read for ACK message
-        msg = self.ser.read(self.ser.in_waiting)
-        print("Got SBEP ACK msg: {}".format(msg))
-        ack = self.ser.read(1)
-        print("Got SBEP ACK: {}".format(ack))
+        # read for ACK message, after anything already waiting
+        if self.ser.in_waiting:
+            self.read(self.ser.in_waiting)
+        ack = self.read(1)
         if len(ack) and ack[0] == 0x50:
+            if speed != self.baudrate:
+                self.ser.baudrate = speed
             return 0
         else:
             self.busy(0)
             raise RuntimeError("Failed to enter SBEP mode. (ack=%s)" % ack)
 
     def sbep_leave(self):
-        """Leave SBEP mode"""
-        print("Leaving SBEP mode")
-        self.busy(0)
-        while self.isBusy():
-            sleep(0.001)
+        """Leave SBEP mode, going back to 9600 baud if the session was faster"""
+        try:
+            self.busy(0)
+        finally:
+            if self.ser.baudrate != self.baudrate:
+                self.ser.baudrate = self.baudrate
+        self.wait_not_busy()
 
     def sbep_send(self, opcode, data):
         """Send SBEP message"""
-        # Data length including CRC
-        datalen = len(data) + 1
-
-        # Determine where OP code is in header
-        hdr = 0
-        if opcode >= 0xF:
-            hdr |= 0xF0
-            extop = opcode
-        else:
-            hdr |= (opcode << 4)
-            extop = None
-
-        # Determine where length code is in header
-        if datalen >= 0xF:
-            hdr |= 0x0F
-            extlen = datalen
-            if not extop:
-                extop = 0
-        else:
-            hdr |= datalen & 0xF
-            extlen = None
-
         # Build message
-        msg = bytes((hdr,))
-        if extop is not None:
-            msg += bytes((extop,))
-        if extlen is not None:
-            msg += bytes((extlen,))
-        msg += data
-        msg += bytes((sbep_CRC(msg),))
-
-        print(" SENT>: {}".format(hexlify(msg, ' ')))
+        msg = sbep_frame(opcode, data)
 
         # Send message
         self.ser.flushInput()
         self.write(msg)
 
         # Check our message got sent properly
-        msgchk = self.ser.read(len(msg))
-        if msgchk != msg:
+        if not self._echo(msg):
             raise RuntimeError("Message was not sent properly!")
 
         # Get ack
@@ -208,34 +838,17 @@ class Serial:
         # Store entire message to verify checksum
         msg = b''
 
-        # Get header
-        hdr = self.ser.read(1)[0]
-        msg += bytes((hdr,))
-
-        # Decode header
-        op = (hdr >> 4) & 0xF
-        datalen = hdr & 0xF
-
-        if op == 0xF:
-            op = self.ser.read(1)[0]
-            msg += bytes((op,))
-
-        if datalen == 0xF:
-            if op != 0xF:
-                msg += self.ser.read(1)
-            datalen = self.ser.read(1)[0]
-            msg += bytes((datalen,))
-
-        # Get data
-        data = self.ser.read(datalen)
-        msg += data
-
-        # Verify checksum
-        if sbep_CRC(msg):
-            raise RuntimeError("SBEP checksum failed")
-
-        # Return operation and data without checksum appended
-        return op, data[:-1]
+        # Read header bytes until we know the length, then the rest of it
+        msglen = None
+        while msglen is None or len(msg) < msglen:
+            more = self.read(1 if msglen is None else msglen - len(msg))
+            if not more:
+                raise RuntimeError("Timed out waiting for SBEP message")
+            msg += more
+            msglen = sbep_length(msg, 0, len(msg))
+
+        # Verify checksum, return operation and data without checksum appended
+        return sbep_parse(msg)
 
 
 if __name__ == "__main__":
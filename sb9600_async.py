@@ -0,0 +1,277 @@
+# SB9600 - asyncio transport
+#
+# Awaitable versions of the sb9600.Serial routines, so a single event loop can
+# listen, send commands and run SBEP sessions on several radios at once
+# without threads or busy loops.
+#
+
+import asyncio
+import random
+from contextlib import asynccontextmanager
+
+import sb9600
+
+
+class AsyncSerial:
+    """asyncio front end for an sb9600.Serial
+
+    Received bytes are collected by a reader registered on the event loop
+    (or a sleeping poll task on platforms that can't select on serial ports)
+    and handed out through the awaitable read/recv routines. The BUSY line
+    can't be waited on directly, so it is polled with short sleeps.
+    """
+
+    def __init__(self, bus, poll=0.001):
+        """
+        Args:
+            bus (sb9600.Serial): opened bus to drive
+            poll (float, optional): interval for polling BUSY, and the port
+                                    itself if it can't be selected on (seconds)
+        """
+        self.bus = bus
+        self.ser = bus.ser
+        self.poll = poll
+        # Only one transaction on the bus at a time
+        self.lock = asyncio.Lock()
+        self._rx = bytearray()
+        self._data = asyncio.Event()
+        self._fd = None
+        self._task = None
+
+    async def start(self):
+        """Start collecting received bytes"""
+        loop = asyncio.get_running_loop()
+        try:
+            fd = self.ser.fileno()
+            loop.add_reader(fd, self._readable)
+            self._fd = fd
+        except (AttributeError, NotImplementedError):
+            # Windows COM ports / proactor loop, fall back to polling
+            self._task = loop.create_task(self._pollLoop())
+
+    async def close(self):
+        """Stop collecting received bytes"""
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._fd = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _feed(self, data):
+        self._rx += data
+        self._data.set()
+
+    def _readable(self):
+        n = self.ser.in_waiting
+        if n:
+            self._feed(self.bus.read(n))
+
+    async def _pollLoop(self):
+        while True:
+            n = self.ser.in_waiting
+            if n:
+                self._feed(self.bus.read(n))
+            else:
+                await asyncio.sleep(self.poll)
+
+    def flush_input(self):
+        """Throw away anything received so far"""
+        self.ser.reset_input_buffer()
+        self._rx.clear()
+        self._data.clear()
+
+    async def read(self, msglen, timeout=None):
+        """Read msglen bytes
+
+        Like pyserial, returns whatever did arrive if the timeout expires.
+
+        Args:
+            msglen (int): number of bytes wanted
+            timeout (float, optional): seconds to wait. Defaults to the serial
+                                       port's own read timeout.
+
+        Returns:
+            bytes: received bytes
+        """
+        if timeout is None:
+            timeout = self.ser.timeout
+        try:
+            await asyncio.wait_for(self._waitFor(msglen), timeout)
+        except asyncio.TimeoutError:
+            pass
+        msg = bytes(self._rx[:msglen])
+        del self._rx[:msglen]
+        if not self._rx:
+            self._data.clear()
+        return msg
+
+    async def recv(self, timeout=None):
+        """Wait for bytes to arrive and return everything received
+
+        Args:
+            timeout (float, optional): give up after this many seconds and
+                                       return empty. Defaults to waiting forever.
+
+        Returns:
+            bytes: received bytes
+        """
+        try:
+            await asyncio.wait_for(self._waitFor(1), timeout)
+        except asyncio.TimeoutError:
+            return b''
+        msg = bytes(self._rx)
+        self._rx.clear()
+        self._data.clear()
+        return msg
+
+    async def _waitFor(self, msglen):
+        while len(self._rx) < msglen:
+            self._data.clear()
+            await self._data.wait()
+
+    async def wait_for_quiet(self, time=0.5):
+        """Wait until nothing has been received for a while"""
+        while await self.read(1, time) != b'':
+            pass
+
+    async def wait_not_busy(self, timeout=None):
+        """Wait for the BUSY line to drop
+
+        Args:
+            timeout (float, optional): seconds to wait. Defaults to the bus's
+                                       busy_timeout.
+
+        Raises:
+            sb9600.BusTimeout: if BUSY is still asserted after the timeout
+        """
+        if not self.bus.isBusy():
+            return
+        if timeout is None:
+            timeout = self.bus.busy_timeout
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            while self.bus.isBusy():
+                if loop.time() - start >= timeout:
+                    self.bus.busyTimeouts += 1
+                    raise sb9600.BusTimeout("Timed out waiting for BUSY to drop")
+                await asyncio.sleep(self.poll)
+        finally:
+            self.bus.busyWaitTime += loop.time() - start
+
+    async def sb9600_send(self, address, param1, param2, function):
+        """Send an sb9600 formatted message"""
+        async with self.lock:
+            await self._sb9600_send(address, param1, param2, function)
+
+    async def _sb9600_send(self, address, param1, param2, function):
+        msg = sb9600.frame_cache.frame(address, param1, param2, function)
+
+        attempt = 0
+        while True:
+            # Wait until not busy
+            await self.wait_not_busy()
+
+            # Assert BUSY and send message
+            self.bus.busy(1)
+            try:
+                self.flush_input()
+                self.bus.write(msg)
+
+                # Check our message got sent properly
+                msgchk = await self.read(len(msg))
+            finally:
+                # De-assert BUSY
+                self.bus.busy(0)
+
+            if msgchk == msg:
+                return
+            # Collision, back off (counted on the bus) and try again
+            self.bus.collisions += 1
+            if attempt >= self.bus.retries:
+                raise RuntimeError("Message was not sent properly!")
+            self.bus.retransmits += 1
+            await asyncio.sleep(random.uniform(0, self.bus.backoff * (2 ** attempt)))
+            attempt += 1
+
+    async def sbep_enter(self, speed=9600):
+        """Enter SBEP mode after sending entry command, then switch to speed"""
+        # wait for BUSY to drop
+        await self.wait_not_busy()
+        # set BUSY
+        self.bus.busy(1)
+        # read for ACK message
+        ack = await self.read(1)
+        if len(ack) and ack[0] == 0x50:
+            if speed != self.bus.baudrate:
+                self.bus.ser.baudrate = speed
+            return 0
+        else:
+            self.bus.busy(0)
+            raise RuntimeError("Failed to enter SBEP mode. (ack=%s)" % ack)
+
+    async def sbep_leave(self):
+        """Leave SBEP mode, going back to 9600 baud"""
+        try:
+            self.bus.busy(0)
+        finally:
+            if self.bus.ser.baudrate != self.bus.baudrate:
+                self.bus.ser.baudrate = self.bus.baudrate
+        await self.wait_not_busy()
+
+    async def sbep_send(self, opcode, data):
+        """Send SBEP message"""
+        msg = sb9600.sbep_frame(opcode, data)
+
+        # Send message
+        self.flush_input()
+        self.bus.write(msg)
+
+        # Check our message got sent properly
+        msgchk = await self.read(len(msg))
+        if msgchk != msg:
+            raise RuntimeError("Message was not sent properly!")
+
+    async def sbep_recv(self):
+        """Receive SBEP message, decode the header and check the checksum"""
+        msg = b''
+        while True:
+            n = sb9600.sbep_length(msg, 0, len(msg)) if msg else None
+            if n is not None and len(msg) >= n:
+                break
+            more = await self.read(1 if n is None else n - len(msg))
+            if not more:
+                raise RuntimeError("Timed out waiting for SBEP message")
+            msg += more
+        return sb9600.sbep_parse(msg)
+
+    @asynccontextmanager
+    async def sbep(self, module, speed=9600):
+        """Hold an SBEP session with a module for the duration of a with block
+
+        speed is the session's baud rate, see sb9600.SBEP_SPEEDS.
+
+        Usage:
+            async with abus.sbep(xtl5000.MODULE_FRONTPANEL):
+                await abus.sbep_send(0x21, bytes((0x01, lamp, 0x01)))
+        """
+        code = sb9600.sbep_speed_code(speed)
+        async with self.lock:
+            await self._sb9600_send(0x00, code, module, 0x06)
+            await self.sbep_enter(speed)
+            try:
+                yield self
+            finally:
+                await self.sbep_leave()
@@ -0,0 +1,182 @@
+# Front panel command scheduler
+#
+# At 9600 baud there's only room for a few dozen front panel updates a
+# second. When lamps, backlights or display text are updated faster than
+# that, only the latest value for each one matters, so the scheduler keeps a
+# single pending slot per target and drops anything that gets superseded
+# before it's sent.
+#
+
+import threading
+from collections import OrderedDict
+
+# Pending command kinds, the SBEP ones can share a session
+_SBEP_KINDS = ('lamp', 'icon', 'display')
+
+
+class CommandScheduler:
+    """Background sender for front panel updates with last-write-wins coalescing
+
+    Each lamp, icon, illumination address and display subdevice/offset has one
+    pending slot. A new command for a target replaces whatever is waiting for
+    it and counts as coalesced. Lamps, icons and illumination keep their
+    place in the queue. Display text moves to the back, since writes at
+    different offsets can overlap and must land in the order they were made.
+    Pending SBEP commands are sent together in a single SBEP session.
+
+    The scheduler's thread must be the only thing using the bus while it's
+    running.
+
+    Usage:
+        sched = CommandScheduler(xtl)
+        sched.lamp("L2RED", xtl5000.LAMP_ON)
+        sched.display("HELLO")
+        sched.close()
+    """
+
+    def __init__(self, ctrl, maxBatch=16):
+        """
+        Args:
+            ctrl: controller to send through (xtl5000.XTL, gm1200.GM1200)
+            maxBatch (int, optional): most SBEP commands to send per session
+        """
+        self.ctrl = ctrl
+        self.maxBatch = maxBatch
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.errors = 0
+        self.lastError = None
+
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._busy = False
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="CommandScheduler", daemon=True)
+        self._thread.start()
+
+    # Queueing commands
+
+    def _submit(self, key, args):
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("Scheduler has been closed")
+            if key in self._pending:
+                self.coalesced += 1
+                if key[0] == 'display':
+                    self._pending.move_to_end(key)
+            self._pending[key] = args
+            self.submitted += 1
+            self._cond.notify()
+
+    def lamp(self, lamp, function):
+        """Switch on/off/flash a lamp"""
+        # Build the message now to resolve lamp names to IDs for the key
+        lampid = self.ctrl.lampMsg(lamp, function)[1][1]
+        self._submit(('lamp', lampid), (lamp, function))
+
+    def icon(self, icon, function):
+        """Switch on/off/flash a display icon"""
+        iconid = self.ctrl.iconMsg(icon, function)[1][1]
+        self._submit(('icon', iconid), (icon, function))
+
+    def illumination(self, illum, level):
+        """Change level of illumination"""
+        self._submit(('illum', illum), (illum, level))
+
+    def display(self, text, offset=0, **kwargs):
+        """Send text to the display, see the controller's Display()"""
+        # Resolve the subdevice the way Display() will, so the same one
+        # given by name, by code or by default shares a slot
+        subdev = kwargs.get('subdev', 0x01)
+        if hasattr(self.ctrl, 'subdevCode'):
+            subdev = self.ctrl.subdevCode(subdev)
+        self._submit(('display', subdev, offset), ((text, offset), kwargs))
+
+    # Status
+
+    def stats(self):
+        """Command counts
+
+        Returns:
+            dict: submitted, coalesced, sent, errors and pending
+        """
+        with self._cond:
+            return {
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'sent': self.sent,
+                'errors': self.errors,
+                'pending': len(self._pending),
+            }
+
+    def flush(self, timeout=None):
+        """Wait for everything pending to be sent
+
+        Returns:
+            bool: False if the timeout expired first
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def close(self, timeout=None):
+        """Send whatever's pending and stop the scheduler thread"""
+        self.flush(timeout)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    # Sending
+
+    def _take(self):
+        """Pop the oldest command, plus any other SBEP ones to batch with it"""
+        key, args = self._pending.popitem(last=False)
+        batch = [(key, args)]
+        if key[0] in _SBEP_KINDS:
+            for other in list(self._pending):
+                if len(batch) >= self.maxBatch:
+                    break
+                if other[0] in _SBEP_KINDS:
+                    batch.append((other, self._pending.pop(other)))
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or not self._running)
+                if not self._pending:
+                    return
+                batch = self._take()
+                self._busy = True
+            try:
+                self._send(batch)
+            except Exception as e:
+                with self._cond:
+                    self.errors += 1
+                    self.lastError = e
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _send(self, batch):
+        kind = batch[0][0][0]
+        sent = 0
+        try:
+            if kind == 'illum':
+                self.ctrl.Illumination(*batch[0][1])
+                sent = 1
+            else:
+                with self.ctrl.session() as s:
+                    for key, args in batch:
+                        if key[0] == 'lamp':
+                            s.lamp(*args)
+                        elif key[0] == 'icon':
+                            s.icon(*args)
+                        else:
+                            s.display(*args[0], **args[1])
+                        sent += 1
+        finally:
+            with self._cond:
+                self.sent += sent
@@ -0,0 +1,360 @@
+# Simulated SB9600 bus and radio
+#
+# A VirtualPort stands in for the pyserial port an sb9600.Serial normally
+# opens, and a VirtualRadio sits on the other end of the simulated wire. They
+# follow the same conventions as a real RIB and radio:
+#
+#   - everything sent is echoed back, since we hear our own transmissions
+#   - BUSY is asserted with DTR (or RTS) and sensed on CTS, wired-OR with the
+#     radio's own BUSY
+#   - after an SBEP entry command for one of its modules, the radio ACKs with
+#     0x50 once we assert BUSY, and stays in SBEP mode until we release it.
+#     The entry's speed code must be one in sb9600.SBEP_SPEEDS; the port's
+#     baudrate sets the byte timing, whatever it gets switched to
+#   - SBEP EEPROM reads (0x11) are answered with 0x80 replies from an image
+#   - SBEP display (0x01) and lamp (0x21) writes update a front panel model
+#
+# Bytes take 10 bit times each to cross the wire (9600 baud by default), so
+# throughput and latency can be measured without any hardware.
+#
+
+import threading
+import time
+from array import array
+
+import sb9600
+
+
+class VirtualRadio:
+    """Simulated radio on the far end of a VirtualPort"""
+
+    def __init__(self, eeprom=None, size=0x8000, modules=(0x01, 0x05), turnaround=0.0005):
+        """
+        Args:
+            eeprom (bytes or str, optional): EEPROM image, or path to one.
+                                             Defaults to a blank (0xFF) image.
+            size (int, optional): EEPROM size if no image is given
+            modules (tuple, optional): module addresses that accept SBEP entry
+            turnaround (float, optional): delay before the radio replies to
+                                          anything (seconds)
+        """
+        if isinstance(eeprom, str):
+            with open(eeprom, "rb") as f:
+                eeprom = f.read()
+        if eeprom is None:
+            eeprom = b"\xff" * size
+        self.eeprom = bytes(eeprom)
+        self.modules = modules
+        self.turnaround = turnaround
+
+        # What the radio has been told to do
+        self.received = []
+        self.sbepReceived = []
+        self.sbepEntries = 0
+        self.display = {}
+        self.lamps = {}
+
+        self.port = None
+        self._buf = bytearray()
+        self._pendingEntry = None
+        self.sbepModule = None
+        self.sbepSpeed = 9600
+
+    def attach(self, port):
+        self.port = port
+
+    # Bytes heard on the wire
+
+    def receive(self, data, at):
+        """Handle bytes sent by the master, which finish arriving at 'at'"""
+        self._buf += data
+        while self._buf:
+            if self.sbepModule is not None:
+                n = sb9600.sbep_length(self._buf, 0, len(self._buf))
+                if n is None or n > len(self._buf):
+                    return
+                msg = bytes(self._buf[:n])
+                del self._buf[:n]
+                self._sbepMessage(msg, at)
+            else:
+                if len(self._buf) < 5:
+                    return
+                msg = bytes(self._buf[:5])
+                del self._buf[:5]
+                if sb9600.sb9600_CRC(msg[:4]) != msg[4]:
+                    continue
+                self._sb9600Message(msg, at)
+
+    def _sb9600Message(self, msg, at):
+        self.received.append(msg)
+        address, param1, param2, function = msg[:4]
+        if address == 0x00 and function == 0x06 and param2 in self.modules:
+            # SBEP entry, ACK when BUSY gets asserted. Only speeds in
+            # sb9600.SBEP_SPEEDS are understood.
+            if sb9600.sbep_speed_baud(param1) is not None:
+                self._pendingEntry = param2
+                self.sbepSpeed = sb9600.sbep_speed_baud(param1)
+
+    def _sbepMessage(self, msg, at):
+        self.sbepReceived.append(msg)
+        try:
+            op, data = sb9600.sbep_parse(msg)
+        except RuntimeError:
+            return
+        if op == 0x11 and len(data) >= 4:
+            # EEPROM read
+            length = data[0]
+            addr = data[1] << 16 | data[2] << 8 | data[3]
+            chunk = self.eeprom[addr:addr + length]
+            self.reply(0x80, data[1:4] + chunk, at)
+        elif op == 0x01 and len(data) >= 5:
+            # Display text, attributes follow it
+            count = data[2]
+            offset = data[4]
+            text = self.display.setdefault(data[3], bytearray(b" " * 14))
+            end = min(offset + count, len(text))
+            text[offset:end] = data[5:5 + end - offset]
+        elif op == 0x21 and len(data) >= 3:
+            self.lamps[data[1]] = data[2]
+
+    def busyChanged(self, busy, at):
+        """The master has asserted or released BUSY"""
+        if busy and self._pendingEntry is not None:
+            self.sbepModule = self._pendingEntry
+            self._pendingEntry = None
+            self.sbepEntries += 1
+            self._buf.clear()
+            self.port.transmit(b"\x50", at + self.turnaround)
+        elif not busy and self.sbepModule is not None:
+            self.sbepModule = None
+            self._buf.clear()
+
+    # Things the radio sends
+
+    def reply(self, op, data, at):
+        """Send an SBEP message, framed the way Serial.sbep_recv() expects"""
+        datalen = len(data) + 1
+        hdr = (0xF0 if op >= 0xF else op << 4) | (0x0F if datalen >= 0xF else datalen)
+        msg = bytes((hdr,))
+        if op >= 0xF:
+            msg += bytes((op,))
+        if datalen >= 0xF:
+            if op != 0xF:
+                msg += b"\x00"
+            msg += bytes((datalen,))
+        msg += data
+        msg += bytes((sb9600.sbep_CRC(msg),))
+        self.port.transmit(msg, at + self.turnaround)
+
+    def send(self, address, param1, param2, function):
+        """Put an SB9600 message on the bus, as if the radio sent it"""
+        self.port.transmit(sb9600.sb9600_frame(address, param1, param2, function), busy=True)
+
+    def inject(self, data):
+        """Put raw bytes on the bus, holding BUSY while they're sent"""
+        self.port.transmit(data, busy=True)
+
+
+class VirtualPort:
+    """pyserial-like port wired to a VirtualRadio
+
+    Only the parts of the pyserial API that sb9600.Serial and friends use are
+    provided.
+    """
+
+    def __init__(self, radio=None, baudrate=9600, timeout=0.2, realtime=True):
+        """
+        Args:
+            radio (VirtualRadio, optional): radio on the bus. Defaults to a
+                                            new one with a blank EEPROM.
+            baudrate (int, optional): wire speed, sets the per-byte time
+            timeout (float, optional): read timeout as for pyserial
+            realtime (bool, optional): if False, bytes cross the wire
+                                       instantly and only the radio's
+                                       turnaround delay is simulated
+        """
+        if radio is None:
+            radio = VirtualRadio()
+        self.radio = radio
+        radio.attach(self)
+        self.realtime = realtime
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.inter_byte_timeout = None
+        self.dtr = False
+        self.rts = False
+
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+        self._lock = threading.Condition()
+        self._reading = 0
+        self._cancelRead = False
+        self._rx = bytearray()
+        self._rxTimes = array("d")
+        self._wireFree = 0.0
+        self._radioBusyUntil = 0.0
+
+    @property
+    def byteTime(self):
+        """Time to send one byte (start + 8 data + stop bits)"""
+        return 10.0 / self.baudrate if self.realtime else 0.0
+
+    # The wire
+
+    def transmit(self, data, at=None, busy=False):
+        """Put bytes on the wire, everyone (including us) hears them
+
+        Args:
+            data (bytes): bytes to send
+            at (float, optional): perf_counter time to start sending.
+                                  Defaults to now.
+            busy (bool, optional): hold BUSY while sending (radio traffic)
+
+        Returns:
+            float: time the last byte has been received
+        """
+        with self._lock:
+            now = time.perf_counter()
+            start = max(now if at is None else at, self._wireFree)
+            bt = self.byteTime
+            t = start
+            for b in data:
+                t += bt
+                self._rxTimes.append(t)
+            self._rx += data
+            self._wireFree = t
+            if busy:
+                self._radioBusyUntil = max(self._radioBusyUntil, t)
+            self._lock.notify_all()
+            return t
+
+    def _available(self, now):
+        """Number of buffered bytes that have finished arriving"""
+        times = self._rxTimes
+        n = len(times)
+        if not n or times[0] > now:
+            return 0
+        if times[-1] <= now:
+            return n
+        # Binary search for the first byte still in flight
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[mid] <= now:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _take(self, n):
+        data = bytes(self._rx[:n])
+        del self._rx[:n]
+        del self._rxTimes[:n]
+        self.bytesReceived += n
+        return data
+
+    # pyserial API
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            return self._available(time.perf_counter())
+
+    def read(self, size=1):
+        with self._lock:
+            self._reading += 1
+            try:
+                return self._read(size)
+            finally:
+                self._reading -= 1
+                if not self._reading:
+                    self._cancelRead = False
+
+    def cancel_read(self):
+        """Make a read in progress return what it has so far"""
+        with self._lock:
+            if self._reading:
+                self._cancelRead = True
+                self._lock.notify_all()
+
+    def _read(self, size):
+        start = time.perf_counter()
+        deadline = None if self.timeout is None else start + self.timeout
+        while True:
+            now = time.perf_counter()
+            avail = self._available(now)
+            if avail >= size:
+                return self._take(size)
+            if self.timeout == 0 or self._cancelRead:
+                return self._take(avail)
+            # Work out when the next byte lands
+            wake = deadline
+            if avail < len(self._rxTimes):
+                nxt = self._rxTimes[avail]
+                if self.inter_byte_timeout is not None and avail:
+                    if nxt - self._rxTimes[avail - 1] > self.inter_byte_timeout:
+                        return self._take(avail)
+                if wake is None or nxt < wake:
+                    wake = nxt
+            if deadline is not None and now >= deadline:
+                return self._take(avail)
+            self._lock.wait(None if wake is None else max(wake - now, 0))
+
+    def write(self, data):
+        data = bytes(data)
+        end = self.transmit(data)
+        self.bytesSent += len(data)
+        self.radio.receive(data, end)
+        return len(data)
+
+    def flush(self):
+        """Wait until everything we've sent is on the wire"""
+        with self._lock:
+            delay = self._wireFree - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._take(self._available(time.perf_counter()))
+
+    flushInput = reset_input_buffer
+
+    def reset_output_buffer(self):
+        pass
+
+    def setDTR(self, value=1):
+        self._setBusy("dtr", bool(value))
+
+    def setRTS(self, value=1):
+        self._setBusy("rts", bool(value))
+
+    def _setBusy(self, line, value):
+        if getattr(self, line) != value:
+            setattr(self, line, value)
+            self.radio.busyChanged(self.dtr or self.rts, time.perf_counter())
+
+    def getCTS(self):
+        return self.dtr or self.rts or time.perf_counter() < self._radioBusyUntil
+
+    @property
+    def cts(self):
+        return self.getCTS()
+
+    def close(self):
+        pass
+
+
+def Serial(radio=None, busy_is_RTS=False, busy_timeout=2.0, retries=3, backoff=0.005, **kwargs):
+    """Make an sb9600.Serial on a simulated bus
+
+    Args:
+        radio (VirtualRadio, optional): radio on the bus
+        busy_is_RTS, busy_timeout, retries, backoff: as for sb9600.Serial
+        **kwargs: passed on to VirtualPort
+
+    Returns:
+        sb9600.Serial: bus, with the VirtualPort as bus.ser
+    """
+    return sb9600.Serial(VirtualPort(radio, **kwargs), busy_is_RTS, busy_timeout, retries, backoff)
@@ -0,0 +1,165 @@
+# Radio state built up from decoded events
+#
+# RadioState is an event sink (see events.py) that keeps the latest known
+# value of everything the decoder can tell us about the radio, so consumers
+# can just look things up rather than following the message stream
+# themselves.
+#
+# Keys:
+#   transmit, monitor       bool, from broadcast channel state (0x0A)
+#   muted                   bool, from radio audio (0x1D)
+#   channel_state           'idle' or 'rx', from radio channel state (0x1E)
+#   channel                 channel number acknowledged by the radio (0x60)
+#   channel_requested       channel last asked for (0x1F)
+#   display.<subdev>        text on a display subdevice, from SBEP display
+#                           writes
+#   icon.<name>             bool, display icons from SBEP icon messages
+#   backlight.<target>      illumination level, from panel lighting (0x58)
+#
+
+import threading
+
+# Characters per display subdevice
+DISPLAY_WIDTH = 14
+
+
+class RadioState:
+    """Latest known radio state, fed by an XTL decoder as a sink
+
+    Usage:
+        state = RadioState()
+        xtl = xtl5000.XTL(bus, sinks=[events.ConsoleSink(), state])
+        state.subscribe(lambda key, old, new, event: print(key, new), keys=['transmit'])
+        ...
+        if state.get('transmit'):
+            ...
+
+    Subscribers are called from whatever thread delivers the events, and only
+    when a value actually changes.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._times = {}
+        self._displays = {}
+        self._subscribers = {}
+        self._allSubscribers = {}
+        self._nextToken = 0
+        self._lock = threading.Lock()
+        self._handlers = {
+            'chan_state': self._chanState,
+            'audio': self._audio,
+            'channel': self._channel,
+            'chan_change': self._chanChange,
+            'display': self._display,
+            'icon': self._icon,
+            'lighting': self._lighting,
+        }
+
+    # Reading
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def updated(self, key):
+        """Timestamp of the event that last changed a value, or None"""
+        return self._times.get(key)
+
+    def snapshot(self):
+        """Copy of all the current values
+
+        Returns:
+            dict: key to value
+        """
+        with self._lock:
+            return dict(self._values)
+
+    # Subscribing
+
+    def subscribe(self, callback, keys=None):
+        """Be told about changes
+
+        Args:
+            callback (callable): called as callback(key, old, new, event),
+                                 old being None for a value not seen before
+            keys (iterable, optional): only these keys. Defaults to all.
+
+        Returns:
+            int: token to unsubscribe with
+        """
+        with self._lock:
+            token = self._nextToken
+            self._nextToken += 1
+            if keys is None:
+                self._allSubscribers[token] = callback
+            else:
+                for key in keys:
+                    self._subscribers.setdefault(key, {})[token] = callback
+        return token
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._allSubscribers.pop(token, None)
+            for subs in self._subscribers.values():
+                subs.pop(token, None)
+
+    # Updating
+
+    def __call__(self, event):
+        handler = self._handlers.get(event.kind)
+        if handler is not None:
+            handler(event)
+
+    def set(self, key, value, event=None):
+        """Change a value, telling subscribers if it's different"""
+        with self._lock:
+            old = self._values.get(key)
+            if key in self._values and old == value:
+                return
+            self._values[key] = value
+            if event is not None:
+                self._times[key] = event.timestamp
+            callbacks = list(self._allSubscribers.values())
+            if key in self._subscribers:
+                callbacks.extend(self._subscribers[key].values())
+        for callback in callbacks:
+            callback(key, old, value, event)
+
+    def _chanState(self, event):
+        self.set(event.fields['mode'].lower(), event.fields['on'], event)
+
+    def _audio(self, event):
+        self.set('muted', event.fields['muted'], event)
+
+    def _channel(self, event):
+        if event.fields['state'] is not None:
+            self.set('channel_state', event.fields['state'], event)
+
+    def _chanChange(self, event):
+        if event.fields['ack']:
+            self.set('channel', event.fields['channel'], event)
+        else:
+            self.set('channel_requested', event.fields['channel'], event)
+
+    def _display(self, event):
+        subdev = event.fields['subdev']
+        offset = event.fields['offset']
+        text = event.fields['text']
+        with self._lock:
+            chars = self._displays.setdefault(subdev, [" "] * DISPLAY_WIDTH)
+            end = min(offset + len(text), DISPLAY_WIDTH)
+            chars[offset:end] = text[:end - offset]
+            value = "".join(chars)
+        self.set("display." + subdev, value, event)
+
+    def _icon(self, event):
+        self.set("icon." + event.fields['icon'], event.fields['on'], event)
+
+    def _lighting(self, event):
+        self.set("backlight." + event.fields['target'], event.fields['level'], event)
@@ -0,0 +1,52 @@
+#
+#   Regression tests for EEPROM reading, run against the simulated bus
+#
+#   python -m unittest test_eeprom
+#
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import eeprom
+import simbus
+import xtl5000
+
+
+def radio(size=0x800):
+    image = bytes(random.Random(size).randrange(256) for _ in range(size))
+    radio = simbus.VirtualRadio(eeprom=image)
+    return image, xtl5000.XTL(simbus.Serial(radio, realtime=False))
+
+
+class EEPROMTest(unittest.TestCase):
+
+    def test_read_short_last_chunk(self):
+        # 0x7f0 bytes, so the last chunk is 0x30 and ends at the top
+        image, xtl = radio()
+        self.assertEqual(xtl.ReadEEPROM(1, 0x10, 0x800), image[0x10:])
+
+    def test_view_short_last_page(self):
+        image, xtl = radio()
+        with eeprom.EEPROMView(xtl, 1, 0x7f0, 0x800, retries=0) as ee:
+            self.assertEqual(ee[-4:], image[-4:])
+            self.assertEqual(ee[::-1], image[:0x7ef:-1])
+            self.assertEqual(ee.pagesFetched, 1)
+
+    def test_view_cache_short_last_page(self):
+        image, xtl = radio()
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        out = os.path.join(tmp, "pages.bin")
+        with eeprom.EEPROMView(xtl, 1, 0x7d0, 0x800, out=out) as ee:
+            self.assertEqual(ee[:], image[0x7d0:])
+        self.assertEqual(os.path.getsize(out), 0x30)
+        with eeprom.EEPROMView(xtl, 1, 0x7d0, 0x800, out=out) as ee:
+            self.assertEqual(ee[0x20:], image[0x7f0:])
+            self.assertEqual(ee.pagesFetched, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
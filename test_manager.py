@@ -0,0 +1,41 @@
+#
+#   Regression tests for the bus manager, run against the simulated bus
+#
+#   python -m unittest test_manager
+#
+
+import time
+import unittest
+
+import manager
+import simbus
+
+
+class BusManagerTest(unittest.TestCase):
+
+    def test_bad_frame_keeps_radio(self):
+        # A sink that chokes on one frame mustn't take the radio off the bus
+        radio = simbus.VirtualRadio()
+        got = []
+
+        def sink(event):
+            if event.fields.get('channel') == 1:
+                raise KeyError("channel")
+            got.append(event)
+
+        with manager.BusManager() as mgr:
+            managed = mgr.add("test", simbus.Serial(radio), sinks=[sink])
+            mgr.start()
+            with self.assertLogs(manager.log, 'ERROR'):
+                radio.send(0x01, 0x00, 0x01, 0x1F)
+                radio.send(0x01, 0x00, 0x02, 0x1F)
+                deadline = time.time() + 2
+                while not got and time.time() < deadline:
+                    time.sleep(0.01)
+            self.assertIsNone(managed.error)
+            self.assertEqual(managed.decodeErrors, 1)
+            self.assertEqual(got[0].fields['channel'], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
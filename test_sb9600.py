@@ -0,0 +1,90 @@
+#
+#   Regression tests for the SB9600/SBEP frame parser
+#
+#   python -m unittest test_sb9600
+#
+
+import random
+import unittest
+
+import sb9600
+import xtl5000
+
+
+def frame(address, param1, param2, function):
+    return sb9600.sb9600_frame(address, param1, param2, function)
+
+
+# SBEP entry to the front panel at 9600 baud, the module's ACK and a lamp
+# message to send in the session
+ENTRY = frame(0x00, 0x12, 0x05, 0x06)
+ACK = b"\x50"
+LAMP = sb9600.sbep_frame(0x21, bytes((0x01, 0x0D, 0x01)))
+
+
+def parse(data, chunks=None):
+    """Feed data through a parser, optionally in the given chunk sizes"""
+    parser = sb9600.FrameParser()
+    out = []
+    pos = 0
+    for n in chunks or []:
+        out += [(sbep, bytes(msg)) for sbep, msg in parser.feed(data[pos:pos + n])]
+        pos += n
+    if pos < len(data):
+        out += [(sbep, bytes(msg)) for sbep, msg in parser.feed(data[pos:])]
+    return parser, out
+
+
+class FrameParserTest(unittest.TestCase):
+
+    def test_sb9600_after_session(self):
+        # 01 fe passes the SBEP checksum as a two byte message, but it's the
+        # start of a radio frame
+        radio = frame(0x01, 0xFE, 0x00, 0x1E)
+        parser, out = parse(ENTRY + ACK + LAMP + radio)
+        self.assertEqual(out, [(False, ENTRY), (True, LAMP), (False, radio)])
+        self.assertEqual(parser.dropped, 0)
+
+    def test_sb9600_after_session_byte_at_a_time(self):
+        radio = frame(0x01, 0xFE, 0x00, 0x1E)
+        data = ENTRY + ACK + LAMP + radio
+        parser, out = parse(data, [1] * len(data))
+        self.assertEqual(out, [(False, ENTRY), (True, LAMP), (False, radio)])
+        self.assertEqual(parser.dropped, 0)
+
+    def test_sessions_then_sb9600(self):
+        # Batches of display, lamp and icon updates, each followed by radio
+        # traffic, read in random sized chunks
+        xtl = xtl5000.XTL(None, sinks=[])
+        rng = random.Random(1)
+        want = []
+        data = b""
+        for i in range(2000):
+            want.append((False, ENTRY))
+            data += ENTRY + ACK
+            for j in range(rng.randint(1, 4)):
+                kind = rng.randrange(3)
+                if kind == 0:
+                    text = "".join(rng.choice("ABC0123: ") for _ in range(rng.randint(1, 14)))
+                    op, payload = xtl.displayMsg(text, rng.randint(0, 3), rng.randint(0, 2), full=True)
+                elif kind == 1:
+                    op, payload = xtl.lampMsg(rng.choice(list(xtl5000.lamps_map)), rng.randint(0, 2))
+                else:
+                    op, payload = xtl.iconMsg(rng.choice(list(xtl.display_icons_o5)), rng.randint(0, 2))
+                msg = sb9600.sbep_frame(op, payload)
+                want.append((True, msg))
+                data += msg + ACK
+            for j in range(rng.randint(1, 6)):
+                msg = frame(rng.choice((0x00, 0x01, 0x05)), rng.randrange(256), rng.randrange(256),
+                            rng.choice((0x0A, 0x1D, 0x1E, 0x1F, 0x57, 0x58, 0x60)))
+                want.append((False, msg))
+                data += msg
+        chunks = [rng.randint(1, 16) for _ in range(len(data) // 8)]
+        parser, out = parse(data, chunks)
+        self.assertEqual(out, want)
+        self.assertEqual(parser.dropped, 0)
+        self.assertEqual(parser.resyncs, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+#
+#   Regression tests for the XTL controller, run against the simulated bus
+#
+#   python -m unittest test_xtl5000
+#
+
+import unittest
+from binascii import unhexlify
+
+import sb9600
+import simbus
+import xtl5000
+
+
+class DisplayTest(unittest.TestCase):
+
+    def test_display_after_failed_entry(self):
+        # The front panel doesn't answer SBEP entry, so nothing reaches the
+        # display. Once it does, the text still has to be sent.
+        radio = simbus.VirtualRadio(modules=(0x01,))
+        xtl = xtl5000.XTL(simbus.Serial(radio, realtime=False))
+        with self.assertRaises(RuntimeError):
+            xtl.Display("HELLO")
+        radio.modules = (0x01, 0x05)
+        xtl.Display("HELLO")
+        self.assertEqual(bytes(radio.display[0x01][:5]), b"HELLO")
+
+    def test_display_skips_unchanged(self):
+        radio = simbus.VirtualRadio()
+        xtl = xtl5000.XTL(simbus.Serial(radio, realtime=False))
+        xtl.Display("HELLO")
+        sent = len(radio.sbepReceived)
+        xtl.Display("HELLO")
+        self.assertEqual(len(radio.sbepReceived), sent)
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_non_ascii_display(self):
+        # Someone else writes bytes that aren't ASCII to the display
+        radio = simbus.VirtualRadio()
+        bus = simbus.Serial(radio, realtime=False)
+        got = []
+        xtl = xtl5000.XTL(bus, sinks=[got.append])
+        text = sb9600.sbep_frame(0x01, bytes((0x80, 0x02, 0x02, 0x01, 0x00)) + b"\xee\xb9\x00\x00")
+        radio.inject(sb9600.sb9600_frame(0x00, 0x12, 0x05, 0x06) + b"\x50" + text)
+        parser = sb9600.FrameParser()
+        for sbep, msg in parser.feed(bus.recv(timeout=0.5, interbyte=0.05)):
+            xtl.processMsg(msg, sbep)
+        self.assertEqual([e.kind for e in got], ['sbep_enter', 'display'])
+        self.assertEqual(got[1].fields['text'], "\ufffd\ufffd")
+
+        # and then we put our own text back
+        xtl.Display("HE")
+        self.assertEqual(bytes(radio.display[0x01][:2]), b"HE")
+
+    def test_garbled_display(self):
+        xtl = xtl5000.XTL(None, sinks=[])
+        event = xtl.processMsg(unhexlify("14809a26f333eeb9de"), True)
+        self.assertEqual(event.kind, 'display')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# Tracing the send, receive and decode paths
+#
+# sb9600.Serial, sb9600.FrameParser and xtl5000.XTL each have a 'tracer'
+# attribute. It's None normally, which costs one attribute check per stage.
+# Set it to a callable and it gets called as
+#
+#   tracer(stage, start_ns, end_ns, info)
+#
+# with perf_counter_ns() timestamps for each stage:
+#
+#   busy_wait   waiting for BUSY to drop before sending     info: None
+#   write       writing to the port                         info: bytes sent
+#   echo        reading back what we sent                   info: bytes heard
+#   read        reading from the port                       info: bytes read
+#   parse       finding a frame in the received bytes       info: the frame
+#   decode      decoding a message and running the sinks    info: events.Event
+#
+# TraceFile writes them to a CSV file, PrintTracer prints the traffic like
+# the old debug prints did. Run this file on a trace for per-stage timings:
+#
+#   python tracing.py TRACEFILE
+#
+
+import sys
+from binascii import hexlify
+
+STAGES = ('busy_wait', 'write', 'echo', 'read', 'parse', 'decode')
+
+
+def attach(tracer, bus=None, parser=None, xtl=None):
+    """Set the tracer on any of a bus, parser and decoder. Pass None as the
+    tracer to turn tracing off again."""
+    for target in (bus, parser, xtl):
+        if target is not None:
+            target.tracer = tracer
+
+
+def _infoText(info):
+    if info is None:
+        return ""
+    if isinstance(info, (bytes, bytearray, memoryview)):
+        return hexlify(bytes(info), ' ').decode()
+    # Decoded events
+    return info.kind
+
+
+class TraceFile:
+    """Write each traced stage to a CSV file
+
+    Columns are stage, start_ns, end_ns, duration_ns and info (bytes in hex,
+    or the kind of a decoded event).
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.file.write("stage,start_ns,end_ns,duration_ns,info\n")
+
+    def __call__(self, stage, start, end, info):
+        self.file.write("{},{},{},{},{}\n".format(stage, start, end, end - start, _infoText(info)))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PrintTracer:
+    """Print what goes over the bus, and what it decoded to
+
+    Args:
+        stages (tuple, optional): stages to print
+        file (optional): where to print to. Defaults to stdout.
+    """
+
+    def __init__(self, stages=('write', 'read'), file=None):
+        self.stages = stages
+        self.file = file
+
+    def __call__(self, stage, start, end, info):
+        if stage in self.stages:
+            print("{: >9}>: {}  ({:.3f}ms)".format(stage.upper(), _infoText(info), (end - start) / 1e6),
+                  file=self.file or sys.stdout)
+
+
+class Tracers:
+    """Send each stage to several tracers"""
+
+    def __init__(self, *tracers):
+        self.tracers = list(tracers)
+
+    def __call__(self, stage, start, end, info):
+        for tracer in self.tracers:
+            tracer(stage, start, end, info)
+
+
+def summarise(path):
+    """Per-stage timings from a TraceFile
+
+    Returns:
+        dict: stage to a dict of count, total, mean, p50, p99 and max
+              durations (ns)
+    """
+    durations = {}
+    with open(path) as f:
+        next(f)
+        for line in f:
+            stage, start, end, duration = line.split(",", 4)[:4]
+            durations.setdefault(stage, []).append(int(duration))
+    out = {}
+    for stage, d in durations.items():
+        d.sort()
+        out[stage] = {
+            'count': len(d),
+            'total': sum(d),
+            'mean': sum(d) / len(d),
+            'p50': d[len(d) // 2],
+            'p99': d[min(len(d) - 1, len(d) * 99 // 100)],
+            'max': d[-1],
+        }
+    return out
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python tracing.py TRACEFILE")
+        sys.exit(1)
+    stats = summarise(sys.argv[1])
+    print("{: >10} {: >8} {: >12} {: >10} {: >10} {: >10}".format("stage", "count", "total ms", "mean us",
+                                                                   "p99 us", "max us"))
+    order = [s for s in STAGES if s in stats] + sorted(s for s in stats if s not in STAGES)
+    for stage in order:
+        s = stats[stage]
+        print("{: >10} {: >8} {: >12.2f} {: >10.1f} {: >10.1f} {: >10.1f}".format(
+            stage, s['count'], s['total'] / 1e6, s['mean'] / 1e3, s['p99'] / 1e3, s['max'] / 1e3))
@@ -5,9 +5,11 @@
 # Modified for use with XTL series SB9600/SBEP commands by W3AXL
 #
 
-from time import sleep
-from binascii import hexlify, unhexlify, b2a_uu
+from time import time, perf_counter_ns
 import sb9600
+import eeprom
+import events
+import protocol
 
 # Addressable modules
 MODULE_BCAST = 0
@@ -15,19 +17,10 @@ MODULE_RADIO = 1
 MODULE_FRONTPANEL = 5
 
 # SBEP module codes
-sbep_modules = {
-    'BCAST': 0x00,
-    'RADIO': 0x01,
-    'PANEL': 0x05
-}
+sbep_modules = protocol.MODULES
 
 # Lamp mappings
-lamps_map = {
-    "L1": 0x0D, "L2RED": 0x0B, "L2GREEN": 0x0C, "L3": 0x01, "L4": 0x02, "L5":
-    0x04, "L5B": 0x05, "L6": 0x10, "L7": 0x07, "L8": 0x11, "L9": 0x12, "L10":
-    0x13, "L11": 0x0E, "L12": 0x0F, "L13": 0x14, "L14": 0x15, "L15": 0x16,
-    "L16": 0x17, "L17": 0x18, "L18": 0x19,
-}
+lamps_map = protocol.HEADS['O5']['lamps']
 
 # Lamp attributes
 LAMP_OFF = 0
@@ -44,212 +37,284 @@ BUTTON_DOWN = 1
 BUTTON_UP = 0
 
 
+# Kinds the decoder falls back to for frames it doesn't understand
+_UNKNOWN_KINDS = frozenset(('unknown_bcast', 'unknown_radio', 'raw'))
+
+# Fields of an SBEP message we don't know, by name and position
+_SBEP_RAW_FIELDS = (('address', 0), ('subaddr', 1), ('length', 2), ('opcode', 4))
+
+
 class XTL:
     """XTL5000 Controller"""
 
-    # O5 Button definitions
-    button_map_o5 = {
-        'ptt': 0x01,
-        'hub': 0x06,
-        'knob_vol': 0x02,
-        'knob_chan': 0x04,
-        'btn_light': 0x54,
-        'btn_dp_lf': 0x80,
-        'btn_home': 0x81,
-        'btn_dp_rg': 0x82,
-        'btn_key_1': 0x83,
-        'btn_key_3': 0x84,
-        'btn_key_5': 0x85,
-        'btn_dp_up': 0x87,
-        'btn_dp_dn': 0x88,
-        'btn_key_2': 0x89,
-        'btn_key_4': 0x8A,
-        'btn_emgcy': 0x94
-    }
-
-    # O5 display icon definitions
-    display_icons_o5 = {
-        'monitor': 0x01,
-        'scan': 0x04,
-        'direct': 0x07,
-        'led_amber': 0x0f,
-        'led_red': 0x10,
-        'low_power': 0x56
-    }
-
-    # O5 display subdevices
-    display_subdev_o5 = {
-        'text_zone': 0x00,
-        'text_channel': 0x01,
-        'text_softkeys': 0x02
-    }
-
-    def __init__(self, bus, head='O5'):
+    # O5 button, display icon and display subdevice codes. See protocol.py
+    # for these and the other heads.
+    button_map_o5 = protocol.HEADS['O5']['buttons']
+    display_icons_o5 = protocol.HEADS['O5']['icons']
+    display_subdev_o5 = protocol.HEADS['O5']['subdevs']
+
+    # Number of decoded SB9600 messages to remember
+    decodeCacheSize = 4096
+
+    def __init__(self, bus, head='O5', sinks=None):
+        """
+        Args:
+            bus (sb9600.Serial): bus the radio is on
+            head (str, optional): control head type
+            sinks (list, optional): callables to pass decoded events.Event
+                                    records to. Defaults to printing them.
+        """
         self.bus = bus
         self.head = head
         self.inSBEP = False
-
-    def processMsg(self,msg):
-        """Process SB9600/SBEP message and decode to human-readable text
+        self._sbepModule = None
+        if sinks is None:
+            sinks = [events.ConsoleSink()]
+        self.sinks = sinks
+
+        # Codes for the head, None if it isn't one protocol.py describes, so
+        # lookups raise the same ValueError they always have
+        self._spec = protocol.load(head) if head in protocol.HEADS else None
+        if self._spec is not None:
+            self._buttons = self._spec.buttonNames
+            self._icons = self._spec.iconNames
+            self._subdevs = self._spec.subdevNames
+        else:
+            self._buttons = self._icons = self._subdevs = None
+        messages = protocol.messages()
+        self._sbepModules = messages.moduleNames
+
+        # SB9600 decoders by (address, function), keyed as address << 8 |
+        # function. Anything missing is passed on raw.
+        methods = {}
+        self._decoders = {}
+        for key, name in messages.decoders.items():
+            if name not in methods:
+                methods[name] = getattr(self, '_decode' + name)
+            self._decoders[key] = methods[name]
+        self._decoded = {}
+        # Frames received by address << 8 | function, and SBEP messages by
+        # kind, for collect()
+        self.frameCounts = {}
+        self.sbepCounts = {}
+        self.unknownFrames = 0
+        # Called as tracer('decode', start_ns, end_ns, event) for each
+        # message decoded and delivered to the sinks. See tracing.py.
+        self.tracer = None
+        # What we've sent to each display subdevice
+        self._shadow = {}
+        # SBEP decoders by opcode
+        self._sbepDecoders = {opcode: getattr(self, '_decode' + name)
+                              for opcode, name in messages.sbepDecoders.items()}
+        # Ready-built front panel frames by (control, value): press and
+        # release for each of the head's buttons, every value for the knobs
+        self._controlFrames = {}
+        if self._spec is not None:
+            for name, code in self._spec.buttons.items():
+                values = range(256) if name.startswith('knob_') else (0, 1)
+                self._controlFrames.update(sb9600.frame_cache.precompute(MODULE_FRONTPANEL, 0x57, (code,), values))
+
+    def processMsg(self, msg, sbep=None, timestamp=None):
+        """Decode an SB9600/SBEP message and pass it on to the sinks
 
         Args:
             msg (byte[]): string of bytes for message
+            sbep (bool, optional): whether msg is an SBEP message, as reported
+                                   by sb9600.FrameParser. If not given, the
+                                   SBEP entry command is tracked here instead.
+            timestamp (float, optional): receive time. Defaults to now.
+
+        Returns:
+            events.Event: the decoded message
         """
 
-        # Decode by device address
+        if self.tracer is not None:
+            start = perf_counter_ns()
+        if timestamp is None:
+            timestamp = time()
+        if sbep is not None:
+            self.inSBEP = sbep
 
         # Handle SBEP first
         if self.inSBEP:
             # reset
             self.inSBEP = False
-            # get important bits
-            address = msg[0]
-            subaddr = msg[1]
-            length = msg[2]
-            opcode = msg[4]          
-            # Get data based on length
-            data = msg[8:length+2]
-
-            # Process message type
-
-            # Display Address
-            if address == 0x1f:
-                # get display subdevice
-                subdev = msg[6]
-                subdevName = self.getDisplaySubDev(subdev)
-                # print data payload
-                self.printMsg("SBEP Disp", "Set {} to '{}'".format(subdevName,data.decode('ascii')))
-                # return
-                return
-
-            # Display icon update 
-            elif address == 0xf4:
-                # get icon
-                icon = self.getDisplayIcon(msg[3])
-                # get state
-                if opcode == 0x01:
-                    state = "on"
+            try:
+                # Dispatch on the opcode, the header byte changes with the
+                # length
+                opcode, data = sb9600.sbep_parse(msg)
+                decoder = self._sbepDecoders.get(opcode)
+                if decoder is None:
+                    kind, fields = self._decodeSbepRaw(msg)
                 else:
-                    state = "off"
-                # print
-                self.printMsg("SBEP Icon","{} ({}) icon {}".format(icon, hex(msg[3]), state))
-                return
-
-            # Fallback to printing raw message
-            else:
-                print("RECVD<: SBEP decoded")
-                print("        Raw Msg: {}".format(hexlify(msg, ' ')))
-                print("        Address: {}, Subaddr: {}, Length: {}, Opcode: {}".format(hex(address), hex(subaddr), length, hex(opcode)))
-                return
+                    kind, fields = decoder(data)
+                if kind == 'display':
+                    # Whoever wrote it, that's what the display shows now
+                    self._shadowWrite(data[3], data[4], data[5:5 + data[2]])
+            except (RuntimeError, IndexError, ValueError):
+                # Bad checksum, too short for what the header says it is, or
+                # no control head to look codes up in
+                kind, fields = self._decodeSbepRaw(msg)
+            self.sbepCounts[kind] = self.sbepCounts.get(kind, 0) + 1
+            event = events.Event(timestamp, self._sbepModule, kind, fields, bytes(msg))
+            self.emit(event)
+            if self.tracer is not None:
+                self.tracer('decode', start, perf_counter_ns(), event)
+            return event
 
         # SB9600 parameters
-        addr = msg[0]
-        param1 = msg[1]
-        param2 = msg[2]
-        function = msg[3]
-
-        # broadcast module
-        if addr == 0x00:
-            # SBEP command
-            if function == 0x06:
-                self.inSBEP = True
-                # Get speed
-                if param1 == 0x12:
-                    speed = 9600
-                else:
-                    speed = param1
-                # Get module name
-                module = self.getSbepModule(param2)
-                # print
-                #print("RECVD<: Entering SBEP mode to {} at {} baud".format(module, speed))
-                return
-            # Channel state command
-            elif function == 0x0A:
-                # Monitor mode
-                if param1 == 0x01:
-                    if param2 == 0x01:
-                        self.printMsg("Chan State","Monitor ON")
-                        return
-                    else:
-                        self.printMsg("Chan State","Monitor OFF")
-                        return
-                # TX mode
-                elif param1 == 0x03:
-                    if param2 == 0x01:
-                        self.printMsg("Chan State","Transmit ON")
-                        return
-                    else:
-                        self.printMsg("Chan State","Transmit OFF")
-                        return
-            # Fallback for unknown message
-            else:
-                self.printMsg("Unknown","Unknown broadcast message function {}: params {}, {}".format(hex(function),hex(param1),hex(param2)))
-                return
-
-        # front panel module
-        if addr == 0x05:
-            # button / knob
-            if function == 0x57:
-                # lookup button
-                btn = self.getButton(param1)
-                if "knob" in btn:
-                    self.printMsg("Btn/Knob","{} clicks: {}".format(btn,param2))
-                    return
-                else:
-                    if param2 == 0x01:
-                        self.printMsg("Btn/Knob","{} pressed".format(btn))
-                        return
-                    else:
-                        self.printMsg("Btn/Knob","{} released".format(btn))
-                        return
-            # backlighting / illumination
-            elif function == 0x58:
-                # display BL
-                if param1 == 0x02:
-                    self.printMsg("Lighting","Display BL set to {}".format(param2))
-                    return
-                elif param1 == 0x03:
-                    self.printMsg("Lighting","Button BL set to {}".format(param2))
-                    return
-
-        # radio module
-        elif addr == 0x01:
-            # audio device
-            if function == 0x1D:
-                if param2 == 0x01:
-                    self.printMsg("Audio","Unmuted")
-                    return
-                elif param2 == 0x00:
-                    self.printMsg("Audio","Muted")
-                    return
-            # channel state?
-            elif function == 0x1e:
-                # Channel idle
-                if param1 == 0x00 and param2 == 0x00:
-                    self.printMsg("Channel","Idle state")
-                    return
-                # Channel RX
-                if param2 == 0x03:
-                    self.printMsg("Channel","RX state")
-                    return
-                else:
-                    self.printMsg("Channel","Unknown state: {} {}".format(hex(param1),hex(param2)))
-                    return
-            # channel change cmd device?
-            elif function == 0x1f:
-                self.printMsg("Chan Change","Goto CH {}".format(param2))
-                return
-            # channel change ack device?
-            elif function == 0x60:
-                self.printMsg("Chan Change","Goto CH {} OK".format(param2))
-                return
-            # fallback
-            else:
-                self.printMsg("Unknown","Unknown message for radio module (0x01): func {}, params {} {}".format(hex(function),hex(param1),hex(param2)))
-                return
-
-        # default to just printing the message if we didn't do anything else
-        self.printMsg("Unknown","Raw SB9600: {}".format(hexlify(msg, ' ')))
+        addr, param1, param2, function = msg[:4]
+
+        key = addr << 24 | param1 << 16 | param2 << 8 | function
+        decoded = self._decoded.get(key)
+        if decoded is None:
+            # Decode by device address and function
+            decoder = self._decoders.get(addr << 8 | function)
+            if decoder is not None:
+                decoded = decoder(param1, param2, function)
+            if decoded is None:
+                # default to just passing on the raw message if we didn't do anything else
+                decoded = ('raw', {})
+            decoded = (self.getSbepModule(addr),) + decoded
+            if len(self._decoded) >= self.decodeCacheSize:
+                self._decoded.clear()
+            self._decoded[key] = decoded
+
+        source, kind, fields = decoded
+
+        counts = self.frameCounts
+        counter = addr << 8 | function
+        counts[counter] = counts.get(counter, 0) + 1
+        if kind in _UNKNOWN_KINDS:
+            self.unknownFrames += 1
+
+        # Broadcast SBEP command, SBEP message follows
+        if kind == 'sbep_enter':
+            self.inSBEP = True
+            self._sbepModule = fields['module']
+
+        event = events.Event(timestamp, source, kind, fields, bytes(msg))
+        self.emit(event)
+        if self.tracer is not None:
+            self.tracer('decode', start, perf_counter_ns(), event)
+        return event
+
+    def collect(self):
+        """Metric families for metrics.Metrics"""
+        frames = [({"address": "0x{:02x}".format(k >> 8), "function": "0x{:02x}".format(k & 0xFF)}, n)
+                  for k, n in sorted(self.frameCounts.items())]
+        sbep = [({"kind": kind}, n) for kind, n in sorted(self.sbepCounts.items())]
+        return [
+            ("xtl_frames_received_total", "counter", "SB9600 frames decoded, by address and function", frames),
+            ("xtl_sbep_messages_received_total", "counter", "SBEP messages decoded, by kind", sbep),
+            ("xtl_unknown_frames_total", "counter", "SB9600 frames that couldn't be decoded",
+             [({}, self.unknownFrames)]),
+            ("xtl_decode_cache_entries", "gauge", "Decoded messages held in the cache",
+             [({}, len(self._decoded))]),
+        ]
+
+    def emit(self, event):
+        """Pass an event on to all the sinks"""
+        for sink in self.sinks:
+            sink(event)
+
+    # SBEP decoders, passed the message data without its header and checksum.
+    # They return (kind, fields).
+
+    def _decodeSbepDisplay(self, data):
+        # 0x80, count, count, subdevice, offset, then the text and the same
+        # number of attribute bytes
+        count = data[2]
+        return 'display', {
+            'subdev': self.getDisplaySubDev(data[3]),
+            'code': data[3],
+            'offset': data[4],
+            'text': bytes(data[5:5 + count]).decode('ascii', errors='replace'),
+        }
+
+    def _decodeSbepIcon(self, data):
+        # Display icon update
+        return 'icon', {
+            'icon': self.getDisplayIcon(data[1]),
+            'code': data[1],
+            'on': data[2] == 0x01,
+        }
+
+    def _decodeSbepRaw(self, msg):
+        # Fallback, passed the whole message. Passes on whichever fields it's
+        # long enough to have.
+        return 'sbep_raw', {name: msg[i] for name, i in _SBEP_RAW_FIELDS if i < len(msg)}
+
+    # SB9600 decoders, passed the message parameters. They return the event
+    # (kind, fields), or None to fall back to passing on the raw message.
+    # Results only depend on the message bytes, so processMsg caches them.
+
+    # broadcast module
+
+    def _decodeSbepEntry(self, param1, param2, function):
+        # SBEP command
+        speed = sb9600.sbep_speed_baud(param1) or param1
+        return 'sbep_enter', {'module': self.getSbepModule(param2), 'speed': speed}
+
+    _chanStates = {0x01: "Monitor", 0x03: "Transmit"}
+
+    def _decodeChanState(self, param1, param2, function):
+        # Channel state command, monitor or TX mode
+        mode = self._chanStates.get(param1)
+        if mode is None:
+            return None
+        return 'chan_state', {'mode': mode, 'on': param2 == 0x01}
+
+    def _decodeUnknownBcast(self, param1, param2, function):
+        # Fallback for unknown message
+        return 'unknown_bcast', {'function': function, 'param1': param1, 'param2': param2}
+
+    # front panel module
+
+    def _decodeButton(self, param1, param2, function):
+        # button / knob
+        btn = self.getButton(param1)
+        kind = 'knob' if "knob" in btn else 'button'
+        return kind, {'name': btn, 'code': param1, 'value': param2}
+
+    _illumTargets = {0x02: "Display", 0x03: "Button"}
+
+    def _decodeIllumination(self, param1, param2, function):
+        # backlighting / illumination
+        target = self._illumTargets.get(param1)
+        if target is None:
+            return None
+        return 'lighting', {'target': target, 'level': param2}
+
+    # radio module
+
+    def _decodeAudio(self, param1, param2, function):
+        # audio device
+        if param2 > 0x01:
+            return None
+        return 'audio', {'muted': param2 == 0x00}
+
+    def _decodeChannel(self, param1, param2, function):
+        # channel state?
+        if param1 == 0x00 and param2 == 0x00:
+            state = 'idle'
+        elif param2 == 0x03:
+            state = 'rx'
+        else:
+            state = None
+        return 'channel', {'state': state, 'param1': param1, 'param2': param2}
+
+    def _decodeChanChange(self, param1, param2, function):
+        # channel change cmd device?
+        return 'chan_change', {'channel': param2, 'ack': False}
+
+    def _decodeChanChangeAck(self, param1, param2, function):
+        # channel change ack device?
+        return 'chan_change', {'channel': param2, 'ack': True}
+
+    def _decodeUnknownRadio(self, param1, param2, function):
+        # fallback
+        return 'unknown_radio', {'function': function, 'param1': param1, 'param2': param2}
 
     def getButton(self, code):
         """Lookup button by opcode
@@ -263,13 +328,12 @@ class XTL:
         Returns:
             string: button name
         """
-        if self.head == 'O5':
-            for key, value in self.button_map_o5.items():
-                if code == value:
-                    return key
-            return "{} (Unknown)".format(hex(code))
-        else:
+        if self._buttons is None:
             raise ValueError("Invalid head specified")
+        name = self._buttons.get(code)
+        if name is None:
+            return "{} (Unknown)".format(hex(code))
+        return name
 
     def getSbepModule(self, code):
         """Lookup SBEP module by hex code
@@ -280,10 +344,10 @@ class XTL:
         Returns:
             string: module name
         """
-        for key, value in sbep_modules.items():
-            if code == value:
-                return key
-        return "{} (Unknown)".format(hex(code))
+        name = self._sbepModules.get(code)
+        if name is None:
+            return "{} (Unknown)".format(hex(code))
+        return name
 
     def getDisplaySubDev(self, code):
         """Lookup display subdevice by hex code
@@ -297,13 +361,36 @@ class XTL:
         Returns:
             string: subdevice name
         """
-        if self.head == 'O5':
-            for key, value in self.display_subdev_o5.items():
-                if code == value:
-                    return key
+        if self._subdevs is None:
+            raise ValueError("Invalid head specified")
+        name = self._subdevs.get(code)
+        if name is None:
             return "{} (Unknown)".format(hex(code))
-        else:
+        return name
+
+    def subdevCode(self, subdev):
+        """Lookup display subdevice code by name, integers pass straight through
+
+        Raises:
+            ValueError: if control head invalid
+        """
+        if isinstance(subdev, int):
+            return subdev
+        if self._spec is None:
             raise ValueError("Invalid head specified")
+        return self._spec.subdevs[subdev]
+
+    def buttonCode(self, button):
+        """Lookup button code by name, integers pass straight through
+
+        Raises:
+            ValueError: if control head invalid
+        """
+        if isinstance(button, int):
+            return button
+        if self._spec is None:
+            raise ValueError("Invalid head specified")
+        return self._spec.buttons[button]
 
     def getDisplayIcon(self, code):
         """Lookup display icon by hex code
@@ -317,13 +404,12 @@ class XTL:
         Returns:
             string: icon name
         """
-        if self.head == 'O5':
-            for key, value in self.display_icons_o5.items():
-                if code == value:
-                    return key
-            return "{} (Unknown)".format(hex(code))
-        else:
+        if self._icons is None:
             raise ValueError("Invalid head specified")
+        name = self._icons.get(code)
+        if name is None:
+            return "{} (Unknown)".format(hex(code))
+        return name
 
     def CSQ(self):
         """Enter CSQ mode"""
@@ -332,10 +418,17 @@ class XTL:
     def Reset(self):
         self.bus.sb9600_send(MODULE_BCAST, 0x00, 0x01, 0x08)
 
-    def SBEP(self, module):
-        """Enter SBEP mode"""
-        self.bus.sb9600_send(MODULE_BCAST, 0x12, module, 0x06)
-        self.bus.sbep_enter()
+    def SBEP(self, module, speed=9600):
+        """Enter SBEP mode
+
+        Args:
+            module (int): module to talk to
+            speed (int, optional): baud rate for the session, it must be in
+                                   sb9600.SBEP_SPEEDS
+        """
+        code = sb9600.sbep_speed_code(speed)
+        self.bus.sb9600_send(MODULE_BCAST, code, module, 0x06)
+        self.bus.sbep_enter(speed)
 
     def setChannel(self, channel):
         if channel in range(255):
@@ -345,33 +438,152 @@ class XTL:
             raise ValueError("Channel index out of range")
 
     def sendButton(self, code, value):
-        self.bus.sb9600_send(MODULE_FRONTPANEL, code, value, 0x57)
+        msg = self._controlFrames.get((code, value))
+        if msg is None:
+            msg = sb9600.frame_cache.frame(MODULE_FRONTPANEL, code, value, 0x57)
+        self.bus.send_frame(msg)
 
-    def Display(self, text, offset=0):
-        """Send text to display"""
+    def session(self, module=MODULE_FRONTPANEL, speed=9600):
+        """Start a batch of SBEP operations under one SBEP entry
+
+        Args:
+            module (int, optional): module to talk to
+            speed (int, optional): baud rate for the session
+
+        Returns:
+            sb9600.SBEPSession: context manager for the session
+        """
+        return sb9600.SBEPSession(self, module, speed)
+
+    def displayMsg(self, text, offset=0, subdev=0x01, full=False):
+        """Build the SBEP message to send text to the display
+
+        A shadow copy of each display subdevice is kept, and only the span of
+        characters that differs from what it shows is included. The shadow
+        isn't changed here: it's updated once the message has been sent, see
+        displaySent(), and by display writes decoded by processMsg, including
+        the radio's own.
+
+        Args:
+            text (str): text to write
+            offset (int, optional): character position to write it at
+            subdev (int or str, optional): display subdevice, code or name
+                                           from display_subdev_o5
+            full (bool, optional): send all the text even if it's unchanged
+
+        Raises:
+            ValueError: if the text is too long or the control head invalid
+
+        Returns:
+            (int, bytes): SBEP opcode and data, or None if there's nothing to
+                          change
+        """
 
         if len(text) > 14:
             raise ValueError("Text too long!")
+        subdev = self.subdevCode(subdev)
+        data = bytes(text, "ASCII")
+
+        # Compare against what the display should already be showing. 0xFF
+        # marks characters we don't know, so they always count as changed.
+        if not full:
+            shadow = self._shadow.get(subdev, b"")
+            shadow = bytes(shadow[offset:offset + len(data)]).ljust(len(data), b"\xff")
+            first = 0
+            while first < len(data) and data[first] == shadow[first]:
+                first += 1
+            if first == len(data):
+                return None
+            last = len(data)
+            while data[last - 1] == shadow[last - 1]:
+                last -= 1
+            data = data[first:last]
+            offset += first
 
-        # Build display message
         #msg = bytes((0x80, 0x00, len(text), 0x00, offset))
-        msg = bytes((0x80, len(text), len(text), 0x01, offset))
-        msg += bytes(text, "ASCII")
-        msg += b"\x00" * len(text)  # Character attributes
+        msg = bytes((0x80, len(data), len(data), subdev, offset))
+        msg += data
+        msg += b"\x00" * len(data)  # Character attributes
+        return 0x01, msg
 
-        # Send it
-        self.SBEP(MODULE_FRONTPANEL)
-        self.bus.sbep_send(0x01, msg)
-        self.bus.sbep_leave()
+    def displaySent(self, opcode, data):
+        """Record a message built by displayMsg() as shown on the display
 
-    def Lamp(self, lamp, function):
-        """Switch on/off/flash lamp"""
+        Call it once the message has been sent, so a failed send is tried
+        again next time rather than skipped as unchanged.
+        """
+        self._shadowWrite(data[3], data[4], data[5:5 + data[2]])
+
+    def _shadowFor(self, subdev, end):
+        """Shadow copy of a display subdevice, at least end characters long"""
+        shadow = self._shadow.get(subdev)
+        if shadow is None:
+            shadow = self._shadow[subdev] = bytearray(b"\xff" * 14)
+        if end > len(shadow):
+            shadow.extend(b"\xff" * (end - len(shadow)))
+        return shadow
+
+    def _shadowWrite(self, subdev, offset, data):
+        """Record text written to the display, by us or by the radio"""
+        self._shadowFor(subdev, offset + len(data))[offset:offset + len(data)] = data
+
+    def invalidateDisplay(self, subdev=None):
+        """Forget what the display is showing, so the next update is sent in full
+
+        Args:
+            subdev (int or str, optional): subdevice to forget. Defaults to all.
+        """
+        if subdev is None:
+            self._shadow.clear()
+        else:
+            self._shadow.pop(self.subdevCode(subdev), None)
+
+    def lampMsg(self, lamp, function):
+        """Build the SBEP message to switch on/off/flash a lamp
+
+        Returns:
+            (int, bytes): SBEP opcode and data
+        """
         # If lamp is not an integer, use it as key to look up lampID in map
         if not isinstance(lamp, int):
-            lamp = lamps_map[lamp]
-        self.SBEP(MODULE_FRONTPANEL)
-        self.bus.sbep_send(0x21, bytes((0x01, lamp, function)))
-        self.bus.sbep_leave()
+            lamp = (self._spec.lamps if self._spec is not None else lamps_map)[lamp]
+        return 0x21, bytes((0x01, lamp, function))
+
+    def iconMsg(self, icon, function):
+        """Build the SBEP message to switch on/off/flash a display icon
+
+        Icons are driven the same way as lamps.
+
+        Raises:
+            ValueError: if control head invalid
+
+        Returns:
+            (int, bytes): SBEP opcode and data
+        """
+        if not isinstance(icon, int):
+            if self._spec is None:
+                raise ValueError("Invalid head specified")
+            icon = self._spec.icons[icon]
+        return self.lampMsg(icon, function)
+
+    def Display(self, text, offset=0, subdev=0x01, full=False):
+        """Send text to display, skipping characters it already shows"""
+        msg = self.displayMsg(text, offset, subdev, full)
+        if msg is None:
+            return
+        with self.session(MODULE_FRONTPANEL) as s:
+            s.send(*msg)
+        self.displaySent(*msg)
+
+    def Lamp(self, lamp, function):
+        """Switch on/off/flash lamp"""
+        with self.session(MODULE_FRONTPANEL) as s:
+            s.lamp(lamp, function)
+
+    def Icon(self, icon, function):
+        """Switch on/off/flash display icon"""
+        with self.session(MODULE_FRONTPANEL) as s:
+            s.icon(icon, function)
 
     def Illumination(self, illum, level):
         """Change level of illumination"""
@@ -379,48 +591,12 @@ class XTL:
 
     def Control(self, controlid, value):
         """Indicate a control use"""
-        self.bus.sb9600_send(MODULE_FRONTPANEL, controlid, value & 0xFF, 0x57)
+        self.sendButton(controlid, value & 0xFF)
 
     def ReadEEPROM(self, module, startaddr, endaddr, callback=None):
         """Read EEPROM data. Note: you'll need to reset the radio after this!"""
-        self.CSQ()
-        self.bus.wait_for_quiet()
-
-        # Select device? (TODO: What is this?)
-        # You'll need to reset the radio after this command
-        self.bus.sb9600_send(MODULE_BCAST, module, 0x01, 0x08)
-
-        # Must wait some time before entering SBEP mode
-        sleep(0.5)
-        self.SBEP(MODULE_RADIO)
-
-        # Read the data
-        eedata = b''
-        chunklen = 0x40
-        for addr in range(startaddr, endaddr, chunklen):
-            msg = bytes(
-                (chunklen, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF))
-            self.bus.sbep_send(0x11, msg)
-            op, data = self.bus.sbep_recv()
-            if op == 0x80:  # Reply is EEPROM data
-                addr_rx = data[0] << 16 | data[1] << 8 | data[2]
-                if addr_rx != addr:
-                    raise RuntimeError(
-                        "Unexpected address in reply addr=0x%x" % addr_rx)
-                if len(data[3:]) != chunklen:
-                    raise RuntimeError("Unexpected data length!")
-                eedata += data[3:]
-            else:
-                raise RuntimeError("Unexpected reply op=%d" % op)
-
-            # Notify of progress
-            if callback:
-                callback(addr)
-
-        # Done with SBEP mode
-        self.bus.sbep_leave()
-
-        return eedata
+        reader = eeprom.EEPROMReader(self, module, startaddr, endaddr, callback=callback)
+        return bytes(reader.read())
 
     def Audio(self, enable):
         enable = 1 if enable else 0
@@ -435,6 +611,3 @@ class XTL:
         """Set the transmitter frequency"""
         ch = int((frequency*1E6 / 6250) - 60000)
         self.bus.sb9600_send(0x02, (ch >> 8) & 0xFF, ch & 0xFF, 0x3F)
-
-    def printMsg(self, source, msg):
-        print("{: >10} >>: {}".format(source, msg))